@@ -0,0 +1,123 @@
+"""Normalise addresses from the notices into a consistent 'Number Street, Suburb, Cape Town' format"""
+
+import re
+import sys
+import json
+import time
+from functools import lru_cache
+
+CACHE_SIZE = 8192
+CORPUS_FILE = "address_corpus.json"
+
+# parenthesised text, a separator, or a word
+_TOKEN_RE = re.compile(r"\([^)]*\)|(,)|([^\s,()]+)")
+# words that join two addresses, e.g. '12 LONG STREET AND 14 SHORT STREET'
+_CONJUNCTIONS = frozenset(("and", "&"))
+_NUMBER_RE = re.compile(r"[0-9]+")
+
+
+def normalise_address(address):
+    """
+    Normalise an address for the map.
+
+    Removes parenthesised text, splits on commas and on 'and'/'&' between
+    addresses, keeps only the first of several leading street numbers,
+    title-cases each part and appends 'Cape Town' when missing. Results are
+    memoised, and case and whitespace differences share a cache entry.
+    """
+    if not address:
+        address = ""
+    return _normalise(" ".join(address.split()).lower())
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _normalise(key):
+    parts = []
+    words = []
+    # numbers before the street name, e.g. '12, 14 Long Street' -> '12 Long Street'
+    leading = True
+    number = None
+
+    for match in _TOKEN_RE.finditer(key):
+        separator, word = match.groups()
+        if separator is None and word is None:
+            # parenthesised text is dropped
+            continue
+
+        if separator or word in _CONJUNCTIONS:
+            if words and not leading:
+                parts.append(" ".join(words))
+                words = []
+            continue
+
+        if leading:
+            if _NUMBER_RE.fullmatch(word):
+                if number is None:
+                    number = word
+                continue
+            leading = False
+            if number is not None:
+                words.append(number)
+
+        words.append(word.capitalize())
+
+    if leading and number is not None:
+        words.append(number)
+    if words:
+        parts.append(" ".join(words))
+
+    # add cape town if missing
+    if not parts or parts[-1] != "Cape Town":
+        parts.append("Cape Town")
+    return ", ".join(parts)
+
+
+def cache_info():
+    """Hit and miss counts of the normalisation cache"""
+    return _normalise.cache_info()
+
+
+def check_corpus(corpus_file=CORPUS_FILE):
+    """Check every address in the golden corpus normalises to its expected value"""
+    with open(corpus_file, "r") as f:
+        corpus = json.load(f)
+
+    failures = 0
+    for raw, expected in corpus:
+        result = normalise_address(raw)
+        if result != expected:
+            failures += 1
+            print(f"FAIL {raw!r}\n  expected {expected!r}\n  got      {result!r}")
+    print(f"{len(corpus) - failures}/{len(corpus)} corpus addresses match")
+    return failures == 0
+
+
+def benchmark(count=100_000, corpus_file=CORPUS_FILE):
+    """Time normalising count addresses built from the corpus, cold and memoised"""
+    with open(corpus_file, "r") as f:
+        corpus = [raw for raw, _ in json.load(f)]
+
+    # vary the street numbers so most addresses are unique
+    addresses = [f"{i % 997} {corpus[i % len(corpus)]}" for i in range(count)]
+
+    _normalise.cache_clear()
+    start = time.perf_counter()
+    for address in addresses:
+        normalise_address(address)
+    cold = time.perf_counter() - start
+
+    # a run sees the same few hundred addresses over and over
+    start = time.perf_counter()
+    for i in range(count):
+        normalise_address(addresses[i % 500])
+    warm = time.perf_counter() - start
+
+    print(f"Normalised {count} addresses: {cold:.3f}s unique, {warm:.3f}s repeated")
+    print(cache_info())
+
+
+if __name__ == "__main__":
+    ok = check_corpus()
+    if "--bench" in sys.argv:
+        benchmark()
+    sys.exit(0 if ok else 1)
@@ -1,19 +1,133 @@
 from geopy.geocoders import Nominatim
+from geopy.exc import GeopyError
 from time import sleep
+from datetime import date, timedelta
+import os
+import json
+import time
+import atexit
+import threading
 
 geo = Nominatim(user_agent="cibra-app")
+CACHE_FILE = "coordinates.json"
+# new coordinates are written out in batches, and at exit
+SAVE_EVERY = 50
+SAVE_INTERVAL = 60
+# addresses nominatim didn't find are looked up again after this long
+FAILED_RETRY_DAYS = 30
+_cache_lock = threading.Lock()
+# nominatim allows one request a second, shared by all workers
+_geocode_lock = threading.Lock()
+# the cache file, read once, and the entries not saved yet
+_cache = None
+_unsaved = {}
+_last_save = time.monotonic()
+
+
+def load_cache():
+    """Load previously geocoded addresses"""
+    try:
+        if os.path.exists(CACHE_FILE):
+            with open(CACHE_FILE, "r") as f:
+                return json.load(f)
+    except:
+        pass
+    return {}
+
+
+def save_cache(cache):
+    """Save the geocoded addresses"""
+    tmp_file = CACHE_FILE + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_file, CACHE_FILE)
+
+
+def _loaded():
+    global _cache
+    if _cache is None:
+        _cache = load_cache()
+    return _cache
+
+
+def _save():
+    """Merge the unsaved entries into the cache file, other processes may have added some"""
+    global _cache, _last_save
+    _last_save = time.monotonic()
+    if not _unsaved:
+        return
+    cache = load_cache()
+    cache.update(_unsaved)
+    save_cache(cache)
+    _cache = cache
+    _unsaved.clear()
+
+
+def _remember(address, coordinates):
+    _loaded()[address] = coordinates
+    _unsaved[address] = coordinates
+    if len(_unsaved) >= SAVE_EVERY or time.monotonic() - _last_save > SAVE_INTERVAL:
+        _save()
+
+
+def save_coordinates():
+    """Write out the coordinates not saved yet"""
+    with _cache_lock:
+        _save()
+
+
+atexit.register(save_coordinates)
+
+
+def _retry_due(cached):
+    """Failed lookups are kept as {"failed": date}, older ones as {}"""
+    if "latitude" in cached:
+        return False
+    failed = cached.get("failed")
+    return not failed or date.fromisoformat(failed) < date.today() - timedelta(days=FAILED_RETRY_DAYS)
+
+
+def cached_coordinates():
+    """Every address geocoded before and its coordinates, read once for a batch of records"""
+    with _cache_lock:
+        return dict(_loaded())
+
+
+def seed_coordinates(address, coordinates):
+    """Cache coordinates known without geocoding, unless the address already has some"""
+    with _cache_lock:
+        if "latitude" not in _loaded().get(address, {}):
+            _remember(address, coordinates)
 
 
 def get_coordinates(address):
     """Get gpc cooredinate from a cape town address"""
-    address = f"{address}, Cape Town"
-    location = geo.geocode(address)
-    sleep(1)  # honour rate limits
+    with _cache_lock:
+        cached = _loaded().get(address)
+    if cached is not None and not _retry_due(cached):
+        return cached if "latitude" in cached else {}
+
+    try:
+        with _geocode_lock:
+            try:
+                location = geo.geocode(f"{address}, Cape Town")
+            finally:
+                sleep(1)  # honour rate limits
+    except GeopyError as e:
+        # timeouts and outages aren't cached, the address is tried again next time
+        print(f"ERROR: geocoding {address}, Cape Town failed: {e}")
+        return {}
+
+    coordinates = {}
     if location:
-        return {
+        coordinates = {
             "latitude": location.latitude,
             "longitude": location.longitude,
         }
+    else:
+        print(f"ERROR: no coordinates found for {address}, Cape Town")
 
-    print(f"ERROR: no coordinates found for {address}")
-    return {}
+    # failed lookups are cached too so they don't use up the quota every run
+    with _cache_lock:
+        _remember(address, coordinates or {"failed": date.today().isoformat()})
+    return coordinates
@@ -1,31 +1,18 @@
 """Use gemini api to summarize the application description"""
 
 import os
-import time
-import random
-from google import genai
-from google.genai import types
 import json
+import threading
+from model_router import router
 
-# --- Configuration ---
-# The client automatically picks up the GEMINI_API_KEY environment variable.
-try:
-    client = genai.Client()
-except Exception as e:
-    print(f"Error initializing Gemini client: {e}")
-    print("Please ensure you have set the GEMINI_API_KEY environment variable.")
-    exit()
-
-# Define the model to use
-MODEL = "gemini-2.5-flash"
 # System instruction to define the model's persona and primary task
 SYSTEM_INSTRUCTION = (
     "Summarize the provided text in at most two sentences. Be concise, impersonal, and objective. "
     "Use passive voice. Start directly with the main action or purpose. "
     "No commentary, no em dashes, no extra formatting or punctuation."
 )
-MAX_INPUT_CHARS = 2000
 CACHE_FILE = "summaries.json"
+_cache_lock = threading.Lock()
 
 
 def load_cache():
@@ -45,47 +32,23 @@ def save_cache(cache):
         json.dump(cache, f, indent=2)
 
 
-def _call_model(model: str, text: str, retries: int = 4) -> str:
-    truncated = text[:MAX_INPUT_CHARS]
-    for attempt in range(retries):
-        try:
-            response = client.models.generate_content(
-                model=model,
-                contents=[truncated],
-                config=types.GenerateContentConfig(
-                    system_instruction=SYSTEM_INSTRUCTION,
-                ),
-            )
-            return response.text.strip()
-        except Exception as e:
-            if ("429" in str(e) or "RESOURCE_EXHAUSTED" in str(e)) and attempt < retries - 1:
-                wait = (2 ** attempt) + random.uniform(0, 1)
-                print(f"Rate limited on {model}, retrying in {wait:.1f}s (attempt {attempt + 1}/{retries})...")
-                time.sleep(wait)
-            else:
-                raise
-
-
 def ai_summarise_text(text: str, description_id):
     """Uses the Gemini API to summarize a single block of text."""
-    cache = load_cache()
+    with _cache_lock:
+        cache = load_cache()
     if str(description_id) in cache:
         return cache[str(description_id)]
 
     try:
-        summary = _call_model(MODEL, text)
+        # the router picks the model and falls back to the other on quota errors
+        summary = router.generate("summary", SYSTEM_INSTRUCTION, text)
     except Exception as e:
-        if "429" in str(e) or "RESOURCE_EXHAUSTED" in str(e):
-            print(f"Quota exceeded for {description_id}, retrying with gemini-2.0-flash-lite...")
-            try:
-                summary = _call_model("gemini-2.0-flash-lite", text)
-            except Exception as fallback_e:
-                print(f"Fallback model also failed for {description_id}: {fallback_e}")
-                return None
-        else:
-            print(f"An error occurred during API call for text {description_id}: {e}")
-            return None
-
-    cache[str(description_id)] = summary
-    save_cache(cache)
+        print(f"An error occurred during API call for text {description_id}: {e}")
+        return None
+
+    # reload before saving so concurrent workers don't overwrite each other
+    with _cache_lock:
+        cache = load_cache()
+        cache[str(description_id)] = summary
+        save_cache(cache)
     return summary
\ No newline at end of file
@@ -0,0 +1,138 @@
+"""Merge duplicate map points for the same property into a single point"""
+
+import math
+import re
+from address_to_pin import get_coordinates
+
+# points closer than this are treated as the same property
+MERGE_RADIUS_M = 15
+METRES_PER_DEGREE = 111320
+
+
+def address_key(address):
+    """Normalised address used to match the same property written differently"""
+    key = re.sub(r"[^a-z0-9]+", " ", (address or "").lower())
+    key = re.sub(r"\bcape town\b", " ", key)
+    return " ".join(key.split())
+
+
+def event_key(item):
+    """Events at the same venue are separate points unless they are the same event"""
+    if "end_date" not in item:
+        return None
+    return address_key(item.get("title")), item.get("closing_date", "")
+
+
+def _find(parents, i):
+    """Find the cluster root, compressing the path on the way"""
+    root = i
+    while parents[root] != root:
+        root = parents[root]
+    while parents[i] != root:
+        parents[i], i = root, parents[i]
+    return root
+
+
+def _union(parents, a, b):
+    root_a, root_b = _find(parents, a), _find(parents, b)
+    if root_a != root_b:
+        # keep the earliest item as the root so the merged point is stable
+        parents[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def _unique(values):
+    """Unique non-empty values in their original order"""
+    return list(dict.fromkeys(v for v in values if v))
+
+
+def merge_items(items):
+    """Merge a cluster of items into one point that keeps every source item"""
+    first = items[0]
+    if len(items) == 1:
+        return first
+
+    merged = dict(first)
+    merged["sources"] = [
+        {
+            "email_id": item.get("email_id", ""),
+            "title": item.get("title", ""),
+            "description": item.get("description", ""),
+            "closing_date": item.get("closing_date", ""),
+            "file_link": item.get("file_link", ""),
+        }
+        for item in items
+    ]
+    merged["closing_date"] = "; ".join(_unique(item.get("closing_date") for item in items))
+    merged["file_link"] = " ".join(_unique(item.get("file_link") for item in items))
+    merged["description"] = " ".join(_unique(item.get("description") for item in items))
+    return merged
+
+
+def cluster_items(document_data, radius=MERGE_RADIUS_M, geocode=True):
+    """
+    Merge items for the same property into one map point.
+
+    Items are merged when their normalised addresses match or their geocoded
+    coordinates are within radius metres, events only with the same event.
+    Points are bucketed into a grid of radius sized cells so each point is
+    only compared with its neighbouring cells. The merged point keeps the
+    first item's fields, lists every source item under "sources" and joins
+    their closing dates and links. The items passed in are not changed.
+    """
+    items = [dict(item) for item in document_data if item.get("address")]
+    parents = list(range(len(items)))
+    events = [event_key(item) for item in items]
+
+    # same normalised address
+    by_key = {}
+    for i, item in enumerate(items):
+        key = (address_key(item["address"]), events[i])
+        if key in by_key:
+            _union(parents, by_key[key], i)
+        else:
+            by_key[key] = i
+
+    # nearby coordinates, projected to metres around the mean latitude
+    points = []
+    for i, item in enumerate(items):
+        coordinates = item.get("coordinates")
+        if not coordinates and geocode:
+            coordinates = get_coordinates(item["address"])
+        if coordinates:
+            item["coordinates"] = coordinates
+            points.append((i, coordinates["latitude"], coordinates["longitude"]))
+
+    if points:
+        mean_latitude = sum(p[1] for p in points) / len(points)
+        x_scale = METRES_PER_DEGREE * math.cos(math.radians(mean_latitude))
+
+        grid = {}
+        projected = {}
+        for i, latitude, longitude in points:
+            x, y = longitude * x_scale, latitude * METRES_PER_DEGREE
+            projected[i] = (x, y)
+            grid.setdefault((int(x // radius), int(y // radius)), []).append(i)
+
+        for (cell_x, cell_y), members in grid.items():
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    neighbours = grid.get((cell_x + dx, cell_y + dy))
+                    if not neighbours:
+                        continue
+                    for i in members:
+                        xi, yi = projected[i]
+                        for j in neighbours:
+                            if j <= i or events[i] != events[j]:
+                                continue
+                            xj, yj = projected[j]
+                            if (xi - xj) ** 2 + (yi - yj) ** 2 <= radius ** 2:
+                                _union(parents, i, j)
+
+    clusters = {}
+    for i, item in enumerate(items):
+        clusters.setdefault(_find(parents, i), []).append(item)
+
+    merged = [merge_items(clusters[root]) for root in sorted(clusters)]
+    if len(merged) < len(items):
+        print(f"Merged {len(items)} items into {len(merged)} map points")
+    return merged
@@ -0,0 +1,252 @@
+"""Keep the pipeline running with warm clients, polling hubspot and optionally receiving webhooks"""
+
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import argparse
+import threading
+import traceback
+from functools import partial
+from queue import Queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from main import build_pipeline
+from download_emails import find_emails, fetch_email, match_emails, email_timestamp
+from work_queue import process_email, CATEGORIES
+from export_map_data import export_to_map_csv, export_geojson_tiles
+from retention import retention_due, run_retention
+from pdf_watchdog import quarantine_report
+from records_store import store
+from expiry_queue import ExpiryQueue
+from hubspot_client import client as hubspot
+from drive_index import index as drive_index
+
+POLL_INTERVAL = int(os.environ.get("DAEMON_POLL_INTERVAL", 60))
+# the whole pipeline still runs this often, for expiry and anything a poll missed
+FULL_RUN_HOURS = int(os.environ.get("DAEMON_FULL_RUN_HOURS", 24))
+STATE_FILE = "daemon_state.json"
+# polls search a little before the newest email seen, the search index lags
+WATERMARK_OVERLAP_MS = 10 * 60 * 1000
+WEBHOOK_PORT = int(os.environ.get("DAEMON_WEBHOOK_PORT", 0))
+# only local by default, put it behind a proxy to receive hubspot's posts
+WEBHOOK_HOST = os.environ.get("DAEMON_WEBHOOK_HOST", "127.0.0.1")
+LOCAL_HOSTS = ("127.0.0.1", "::1", "localhost")
+WEBHOOK_PATH = "/webhook"
+# public url hubspot posts to, the v3 signature is over the full url
+WEBHOOK_URL = os.environ.get("DAEMON_WEBHOOK_URL")
+# app client secret, webhook signatures are only checked when it is set
+HUBSPOT_CLIENT_SECRET = os.environ.get("HUBSPOT_CLIENT_SECRET")
+MAX_SIGNATURE_AGE = 300
+
+
+def load_state():
+    try:
+        if os.path.exists(STATE_FILE):
+            with open(STATE_FILE, "r") as f:
+                return json.load(f)
+    except:
+        pass
+    return {}
+
+
+def save_state(state):
+    with open(STATE_FILE, "w") as f:
+        json.dump(state, f, indent=2)
+
+
+def valid_signature(secret, method, uri, body, signature, timestamp):
+    """Check a HubSpot v3 webhook signature"""
+    if not secret:
+        return True
+    if not signature or not timestamp:
+        return False
+    try:
+        # reject old requests so a captured one can't be replayed
+        if abs(time.time() * 1000 - int(timestamp)) > MAX_SIGNATURE_AGE * 1000:
+            return False
+    except ValueError:
+        return False
+    message = f"{method}{uri}{body.decode('utf-8')}{timestamp}".encode("utf-8")
+    digest = hmac.new(secret.encode("utf-8"), message, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode(), signature)
+
+
+class Daemon:
+    """
+    Process new emails as they arrive instead of in cron runs.
+
+    The hubspot, gemini and drive clients stay warm between emails. HubSpot
+    is polled for emails newer than the last one seen, and the webhook
+    receiver can hand over new emails straight away. Each new email is
+    downloaded, extracted and uploaded on its own and its category exported
+    again, so it reaches the map within seconds.
+    """
+
+    def __init__(self, poll_interval=POLL_INTERVAL, full_run_hours=FULL_RUN_HOURS, geojson=False):
+        self.poll_interval = poll_interval
+        self.full_run_hours = full_run_hours
+        self.geojson = geojson
+        self.inbox = Queue()
+        self.watermark = load_state().get("watermark", 0)
+        self.last_full_run = 0
+        self.expiry = ExpiryQueue()
+        # one pipeline run or email at a time, they share the caches and exports
+        self._lock = threading.Lock()
+        self._queued = set()
+        self._queued_lock = threading.Lock()
+
+    def full_run(self):
+        """Run the whole pipeline, which refreshes every category in the records store"""
+        with self._lock:
+            # each full run gets a fresh request budget and drive changes feed
+            hubspot.reset_budget()
+            drive_index.refresh()
+            if retention_due():
+                run_retention()
+            build_pipeline(geojson=self.geojson).run()
+            self.last_full_run = time.time()
+            quarantine_report()
+
+    def poll(self):
+        """Queue the matching emails newer than the watermark"""
+        # the budget is per run, a poll is a run
+        hubspot.reset_budget()
+        since = self.watermark - WATERMARK_OVERLAP_MS if self.watermark else None
+        for email, subject, directory in find_emails(since):
+            self.watermark = max(self.watermark, email_timestamp(email))
+            self.submit(email, subject, directory)
+        save_state({"watermark": self.watermark})
+
+    def receive(self, email_ids):
+        """Queue the emails a webhook notified about, if they match"""
+        for email_id in email_ids:
+            try:
+                email = fetch_email(email_id)
+            except Exception as e:
+                print(f"Error fetching email {email_id}: {e}")
+                continue
+            for email, subject, directory in match_emails([email]):
+                self.submit(email, subject, directory)
+
+    def submit(self, email, subject, directory):
+        """Queue an email that hasn't been downloaded yet"""
+        if os.path.exists(os.path.join(directory, email["id"])):
+            return
+        with self._queued_lock:
+            if email["id"] in self._queued:
+                return
+            self._queued.add(email["id"])
+        self.inbox.put((email, subject, directory))
+
+    def process_inbox(self):
+        while True:
+            email, subject, directory = self.inbox.get()
+            try:
+                with self._lock:
+                    self.process(email, subject, directory)
+            except Exception:
+                print(f"Error processing email {email['id']}")
+                traceback.print_exc()
+            finally:
+                with self._queued_lock:
+                    self._queued.discard(email["id"])
+
+    def process(self, email, subject, directory):
+        """Process one email and export its category again"""
+        start = time.monotonic()
+        items = process_email(email, subject, directory)
+        category = CATEGORIES[directory]
+        store.replace_email(category, email["id"], items)
+
+        data = store.items(category)
+        export_to_map_csv(category, data)
+        if self.geojson:
+            export_geojson_tiles(category, data)
+        print(f"Email {email['id']} on the map in {time.monotonic() - start:.1f}s")
+
+    def run(self, webhook_port=WEBHOOK_PORT, webhook_host=WEBHOOK_HOST):
+        threading.Thread(target=self.process_inbox, name="inbox", daemon=True).start()
+        if webhook_port and not HUBSPOT_CLIENT_SECRET and webhook_host not in LOCAL_HOSTS:
+            # unsigned webhooks from the network would let anyone queue emails
+            print(f"Not listening for webhooks on {webhook_host}: set HUBSPOT_CLIENT_SECRET first")
+        elif webhook_port:
+            server = ThreadingHTTPServer((webhook_host, webhook_port), partial(WebhookHandler, receiver=self))
+            threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+            print(f"Listening for webhooks on {webhook_host}:{webhook_port}{WEBHOOK_PATH}")
+
+        while True:
+            try:
+                if time.time() - self.last_full_run > self.full_run_hours * 3600:
+                    self.full_run()
+                # points come off the map the day they expire
+                with self._lock:
+                    self.expiry.run_due(geojson=self.geojson)
+                self.poll()
+            except Exception:
+                traceback.print_exc()
+            time.sleep(self.poll_interval)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accept HubSpot webhook notifications for new emails"""
+
+    def __init__(self, *args, receiver=None, **kwargs):
+        self.receiver = receiver
+        super().__init__(*args, **kwargs)
+
+    def do_POST(self):
+        if self.path.split("?")[0] != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if WEBHOOK_URL:
+            uri = WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+        else:
+            uri = f"http://{self.headers.get('Host')}{self.path}"
+        if not valid_signature(
+            HUBSPOT_CLIENT_SECRET, "POST", uri, body,
+            self.headers.get("X-HubSpot-Signature-v3"),
+            self.headers.get("X-HubSpot-Request-Timestamp"),
+        ):
+            self.send_error(401)
+            return
+
+        try:
+            events = json.loads(body)
+        except ValueError:
+            self.send_error(400)
+            return
+        if isinstance(events, dict):
+            events = [events]
+        email_ids = [str(event["objectId"]) for event in events if "objectId" in event]
+
+        # reply straight away, hubspot retries slow deliveries
+        threading.Thread(target=self.receiver.receive, args=(email_ids,), daemon=True).start()
+        self.send_response(204)
+        self.end_headers()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the CIBRA notification map up to date continuously")
+    parser.add_argument(
+        "--poll-interval", type=int, default=POLL_INTERVAL,
+        help="seconds between hubspot polls",
+    )
+    parser.add_argument(
+        "--webhook-port", type=int, default=WEBHOOK_PORT,
+        help="also accept hubspot webhooks on this port",
+    )
+    parser.add_argument(
+        "--webhook-host", default=WEBHOOK_HOST,
+        help="address the webhook receiver listens on, 127.0.0.1 by default",
+    )
+    parser.add_argument(
+        "--geojson", action="store_true",
+        help="also export geojson tiles for a browser map",
+    )
+    args = parser.parse_args()
+
+    Daemon(poll_interval=args.poll_interval, geojson=args.geojson).run(args.webhook_port, args.webhook_host)
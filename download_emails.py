@@ -6,8 +6,10 @@ import json
 import requests
 import datetime
 import zipfile
+import threading
+from hubspot_client import client as hubspot, RequestBudgetExceeded
+from fingerprints import index as fingerprints
 
-HUBSPOT_TOKEN = os.environ.get("HUBSPOT_APP_TOKEN")
 NOTICE_DIR = "emails"
 os.makedirs(NOTICE_DIR, exist_ok=True)
 PUBLIC_DIR = "public_part_emails"
@@ -20,14 +22,12 @@ cuttoff_year = 2026
 cuttoff_month = 3
 cuttoff_day = 7
 
-url = "https://api.hubapi.com/crm/v3/objects/emails"
-
-headers = {
-    "Authorization": f"Bearer {HUBSPOT_TOKEN}",
-    "Content-Type": "application/json",
-}
-
 CACHE_FILE = "email_subject.json"
+_cache_lock = threading.Lock()
+# attachments left to download when the email is uploaded to drive
+DEFERRED_FILE = "deferred.json"
+# emails pruned after their closing date, so they aren't downloaded again
+EXPIRED_FILE = "expired_emails.json"
 
 
 def load_cache():
@@ -47,54 +47,105 @@ def save_cache(cache):
         json.dump(cache, f, indent=2)
 
 
-def list_emails():
-    """Use hubspot api to find emails matching filters"""
+def load_expired():
+    """Load the ids of the emails pruned after their closing date"""
+    try:
+        if os.path.exists(EXPIRED_FILE):
+            with open(EXPIRED_FILE, "r") as f:
+                return json.load(f)
+    except:
+        pass
+    return {}
+
+
+# Subject tokens that every email matched by classify_subject contains at
+# least one of. They are searched with CONTAINS_TOKEN so hubspot only returns
+# candidate emails; classify_subject still makes the final decision.
+SUBJECT_TOKENS = [
+    # city notices: notice, land use, erf + case
+    "notice*",
+    "land",
+    "erf",
+    # public participation
+    "participation",
+    "consultation*",
+    "W77*",
+    "WCP*",
+    "HIA",
+    "auction",
+    "say",
+    # the event code prefixes in use, like EO26-0155 and EP26-0066
+    "EO*",
+    "EP*",
+]
+# hubspot allows at most 5 filter groups per search
+MAX_FILTER_GROUPS = 5
+# only what is needed to classify an email, the rest is read for matches
+SEARCH_PROPERTIES = ["hs_email_subject", "hs_timestamp"]
+BODY_PROPERTIES = ["hs_email_text", "hs_email_html", "hs_attachment_ids"]
+# hubspot batch read accepts up to 100 ids per call
+BATCH_READ_SIZE = 100
+
+
+def classify_subject(subject):
+    """Return the directory to download a matching email to, or None to skip it"""
+    if (
+        "fwd" in subject.lower()
+        or "fw:" in subject.lower()
+        or "re:" in subject.lower()
+        or "automatic reply" in subject.lower()
+        or "panel application" in subject.lower()
+        or subject.lower().startswith("form")
+        or "[cibra.co.za]" in subject
+        or "Sucuri Alert" in subject
+        or "Weekly WP Mail SMTP Summary" in subject
+        or "[Cape Town City Bowl Ratepayers' and Residents' Association (CIBRA)]" in subject
+    ):
+        return None
+
+    # export events
+    if re.search(r"E[A-Z]?\d+-\d+\b", subject):
+        return EVENTS_DIR
+
+    # public participation emails
+    if (re.search(r"public\s+participation|consultation", subject, re.IGNORECASE) or re.search(r"W77|WCP", subject, re.IGNORECASE) or re.search(r"(?=.*HIA)(?=.*comment)", subject, re.IGNORECASE) or ("public auction" in subject.lower()) or ("have your say" in subject.lower())):
+        return PUBLIC_DIR
+
+    # city notice emails for noticeboard
+    has_notice = re.search(r"notice", subject, re.IGNORECASE) 
+    has_erf = re.search(r"erf\s+\d+", subject, re.IGNORECASE)
+    has_case = re.search(r"case\s+\d+", subject, re.IGNORECASE)
+    has_land_use = re.search(r"land\s+use", subject, re.IGNORECASE)
+    if not (has_notice or has_land_use or (has_erf and has_case)):
+        # print(f"\t\t\tskipping: {subject}")
+        return None
+
+    return NOTICE_DIR
+
+
+def search_emails(filter_groups, properties):
+    """Page through a hubspot email search"""
     emails = []
-    cutoff = datetime.datetime(
-        cuttoff_year, cuttoff_month, cuttoff_day, tzinfo=datetime.timezone.utc
-    )
-    cutoff_ts = int(cutoff.timestamp() * 1000)
     after = None
 
     while True:
-        # Use filterGroups to only fetch emails after the cutoff date
         payload = {
-            "filterGroups": [
-                {
-                    "filters": [
-                        {
-                            "propertyName": "hs_timestamp",
-                            "operator": "GTE",
-                            "value": str(cutoff_ts),
-                        },
-                    ]
-                }
-            ],
+            "filterGroups": filter_groups,
             "limit": 100,
-            "properties": [
-                "hs_email_subject",
-                "hs_email_text",
-                "hs_email_from",
-                "hs_email_sender_email",
-                "hs_timestamp",
-                "hs_attachment_ids",
-                "hs_email_to_email",
-                "hs_email_html",
-            ],  # properties set data to return
+            "properties": properties,  # properties set data to return
             "sorts": [{"propertyName": "hs_timestamp", "direction": "DESCENDING"}],
         }
         if after:
             payload["after"] = after
 
-        r = requests.post(url + "/search", headers=headers, json=payload)
-        r.raise_for_status()
+        try:
+            r = hubspot.post("/crm/v3/objects/emails/search", json=payload)
+        except RequestBudgetExceeded as e:
+            # process the pages fetched so far
+            print(f"Stopped listing emails: {e}")
+            break
         data = r.json()
-
-        for e in data.get("results", []):
-            ts = datetime.datetime.fromisoformat(
-                e["properties"]["hs_timestamp"].replace("Z", "+00:00")
-            )
-            emails.append(e)
+        emails.extend(data.get("results", []))
 
         if "paging" not in data or "next" not in data["paging"]:
             break
@@ -102,63 +153,156 @@ def list_emails():
         # next page
         after = data["paging"]["next"]["after"]
 
-    # further filter emails to match on subject
+    return emails
+
+
+def list_emails():
+    """Use hubspot api to find emails matching filters"""
+    matched = find_emails()
+
+    # only read the bodies of emails that haven't been downloaded yet
+    new_emails = [
+        (email, subject, directory)
+        for email, subject, directory in matched
+        if not os.path.exists(os.path.join(directory, email["id"]))
+    ]
+    print(f"Matched {len(matched)} emails, {len(new_emails)} new")
+    read_emails([email for email, _, _ in new_emails])
+
+    for email, subject, directory in new_emails:
+        download_email(email, subject, directory)
+
+
+def find_emails(since=None):
+    """
+    Search hubspot for the matching emails, as (email, subject, directory) newest first.
+    since is a timestamp in ms to only search emails newer than, instead of the cutoff date.
+    """
+    cutoff = datetime.datetime(
+        cuttoff_year, cuttoff_month, cuttoff_day, tzinfo=datetime.timezone.utc
+    )
+    cutoff_ts = int(cutoff.timestamp() * 1000)
+    if since:
+        cutoff_ts = max(cutoff_ts, int(since))
+
+    # Use filterGroups to only fetch emails after the cutoff date with one of
+    # the subject tokens. Groups are ORed, so one search per 5 tokens.
+    found = {}
+    for i in range(0, len(SUBJECT_TOKENS), MAX_FILTER_GROUPS):
+        filter_groups = [
+            {
+                "filters": [
+                    {
+                        "propertyName": "hs_timestamp",
+                        "operator": "GTE",
+                        "value": str(cutoff_ts),
+                    },
+                    {
+                        "propertyName": "hs_email_subject",
+                        "operator": "CONTAINS_TOKEN",
+                        "value": token,
+                    },
+                ]
+            }
+            for token in SUBJECT_TOKENS[i:i + MAX_FILTER_GROUPS]
+        ]
+        for email in search_emails(filter_groups, SEARCH_PROPERTIES):
+            found[email["id"]] = email
+
+    # newest first, as hubspot returns each search
+    emails = sorted(
+        found.values(), key=lambda e: e["properties"].get("hs_timestamp") or "", reverse=True
+    )
+
+    matched = match_emails(emails)
+
+    # store id and subject line
+    with _cache_lock:
+        subjects_list = load_cache()
+        for email, subject, _ in matched:
+            subjects_list[email["id"]] = subject
+        save_cache(subjects_list)
+
+    return matched
+
+
+def match_emails(emails):
+    """Filter emails to match on subject, as (email, subject, directory)"""
+    expired = load_expired()
+    matched = []
     for email in emails:
+        if email["id"] in expired:
+            continue
         props = email["properties"]
         subject = props.get("hs_email_subject", "") or ""
         subject = subject.strip()
-        reciever = props.get("hs_email_to_email")
-        sender = props.get("hs_email_sender_email") or ""
-
-        if (
-            "fwd" in subject.lower()
-            or "fw:" in subject.lower()
-            or "re:" in subject.lower()
-            or "automatic reply" in subject.lower()
-            or "panel application" in subject.lower()
-            or subject.lower().startswith("form")
-            or "[cibra.co.za]" in subject
-            or "Sucuri Alert" in subject
-            or "Weekly WP Mail SMTP Summary" in subject
-            or "[Cape Town City Bowl Ratepayers' and Residents' Association (CIBRA)]" in subject
-        ):
-            continue
 
-        # hs_email_sender_email is forwarding email
-        # if "capetown.gov.za" not in sender.lower():
-        #     print(f"skipping sender: {sender}, subject: {subject}")
-        #     continue
+        directory = classify_subject(subject)
+        if directory:
+            matched.append((email, subject, directory))
+    return matched
 
-        # export events
-        if re.search(r"E[A-Z]?\d+-\d+\b", subject):
-            download_email(email, subject, EVENTS_DIR)
-            continue
 
-        # public participation emails
-        if (re.search(r"public\s+participation|consultation", subject, re.IGNORECASE) or re.search(r"W77|WCP", subject, re.IGNORECASE) or re.search(r"(?=.*HIA)(?=.*comment)", subject, re.IGNORECASE) or ("public auction" in subject.lower()) or ("have your say" in subject.lower())):
-            download_email(email, subject, PUBLIC_DIR)
-            continue
+def fetch_email(email_id):
+    """Read one email's subject and timestamp, as the search returns them"""
+    res = hubspot.get(
+        f"/crm/v3/objects/emails/{email_id}",
+        params={"properties": ",".join(SEARCH_PROPERTIES)},
+    )
+    data = res.json()
+    return {"id": str(data["id"]), "properties": data.get("properties", {})}
 
-        # city notice emails for noticeboard
-        has_notice = re.search(r"notice", subject, re.IGNORECASE) 
-        has_erf = re.search(r"erf\s+\d+", subject, re.IGNORECASE)
-        has_case = re.search(r"case\s+\d+", subject, re.IGNORECASE)
-        has_land_use = re.search(r"land\s+use", subject, re.IGNORECASE)
-        if not (has_notice or has_land_use or (has_erf and has_case)):
-            # print(f"\t\t\tskipping: {subject}")
-            continue
 
-        download_email(email, subject, NOTICE_DIR)
+def email_timestamp(email):
+    """hs_timestamp of an email in ms"""
+    value = email["properties"].get("hs_timestamp") or ""
+    if value.isdigit():
+        return int(value)
+    try:
+        return int(datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() * 1000)
+    except ValueError:
+        return 0
+
+
+def remember_subject(email_id, subject):
+    """Add an email's subject line to the subject cache"""
+    with _cache_lock:
+        subjects_list = load_cache()
+        if subjects_list.get(email_id) != subject:
+            subjects_list[email_id] = subject
+            save_cache(subjects_list)
+
+
+def read_emails(emails):
+    """Batch read the email bodies and attachment ids, which the search leaves out"""
+    unread = [e for e in emails if any(p not in e["properties"] for p in BODY_PROPERTIES)]
+    for i in range(0, len(unread), BATCH_READ_SIZE):
+        batch = {email["id"]: email for email in unread[i:i + BATCH_READ_SIZE]}
+        try:
+            r = hubspot.post(
+                "/crm/v3/objects/emails/batch/read",
+                json={
+                    "properties": BODY_PROPERTIES,
+                    "inputs": [{"id": email_id} for email_id in batch],
+                },
+            )
+        except RequestBudgetExceeded as e:
+            print(f"Stopped reading emails: {e}")
+            return
+
+        for result in r.json().get("results", []):
+            email = batch.get(str(result["id"]))
+            if email:
+                email["properties"].update(result.get("properties", {}))
+
+        # mark the emails as read even when a property has no value
+        for email in batch.values():
+            for prop in BODY_PROPERTIES:
+                email["properties"].setdefault(prop, None)
 
 
 def download_email(email, subject, directory):
     # print(f"Matched Email {email["id"]}:\t{subject}")
-    
-    # store id and subject line
-    subjects_list = load_cache()
-    subjects_list[email["id"]] = subject
-    save_cache(subjects_list)
-    
     try:
         # download the attachments
         extract_urls(email, directory)
@@ -168,18 +312,54 @@ def download_email(email, subject, directory):
         traceback.print_exc()
 
 
+def is_notice_file(file_name):
+    """Check if the attachment is one of the notice pdfs that get parsed"""
+    file_name = os.path.basename(file_name).lower()
+    return file_name.startswith("notice") or "advertising" in file_name or "public" in file_name
+
+
+def load_deferred(email_dir):
+    """Load the attachments still to download for an email"""
+    deferred_file = os.path.join(email_dir, DEFERRED_FILE)
+    if os.path.exists(deferred_file):
+        with open(deferred_file, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_deferred(email_dir, deferred):
+    """Save the attachments still to download, or remove the file when there are none"""
+    deferred_file = os.path.join(email_dir, DEFERRED_FILE)
+    if deferred.get("files") or deferred.get("zip"):
+        os.makedirs(email_dir, exist_ok=True)
+        with open(deferred_file, "w") as f:
+            json.dump(deferred, f, indent=2)
+    elif os.path.exists(deferred_file):
+        os.remove(deferred_file)
+
+
 def extract_urls(email, directory):
-    """Get the attachment urls from the email body or the attachment files"""
-    email_text = email["properties"].get("hs_email_text")
-    if not email_text:
-        email_text = email["properties"].get("hs_email_html") or ""
+    """
+    Get the attachment urls from the email body or the attachment files.
+
+    Only the notice pdfs that get parsed are downloaded now, the rest of the
+    attachments are listed in deferred.json and downloaded by fetch_deferred
+    when the email is uploaded to drive. Events are parsed from the subject
+    so all of their attachments are deferred.
+    """
     email_id = email["id"]
     email_dir = os.path.join(directory, email_id)
+    parse_files = directory != EVENTS_DIR
 
     # Check if directory already exists - dont download again
     if os.path.exists(email_dir):
         return
 
+    read_emails([email])
+    email_text = email["properties"].get("hs_email_text")
+    if not email_text:
+        email_text = email["properties"].get("hs_email_html") or ""
+
     # Extract only the BigFilesAccess download URL if it exists in the text
     zip_url_match = re.search(
         r"https://web1\.capetown\.gov\.za/web1/BigFilesAccess/DownloadBigFile\.aspx\?file=[a-f0-9\-]+",
@@ -188,25 +368,25 @@ def extract_urls(email, directory):
     if zip_url_match:
         url = zip_url_match.group(0)
         try:
-            file_res = requests.get(url)
-            file_res.raise_for_status()
-
             os.makedirs(email_dir, exist_ok=True)
-            # download zip file
             filename = os.path.join(email_dir, f"attachments.zip")
-
-            with open(filename, "wb") as out:
-                out.write(file_res.content)
-            print(f"  → Downloaded {filename}")
-            # extract zip file
-            unzip_files(f"{email_dir}/attachments.zip")
+            if parse_files:
+                # the pack is a single archive, so download it but only unzip the notice
+                download_file(url, filename)
+                unzip_files(filename, include=is_notice_file)
+                report_duplicate(email_dir)
+            save_deferred(email_dir, {"zip": url})
             return
         except Exception as e:
             print(f"  → Failed to download {url}: {e}")
+            # leave no empty directory behind so the download is retried
+            if os.path.isdir(email_dir) and not os.listdir(email_dir):
+                os.rmdir(email_dir)
     
     # fallback - try downloading attachments on email
     if email["properties"].get("hs_attachment_ids"):
         attachment_ids = email["properties"]["hs_attachment_ids"].split(";")
+        deferred = []
 
         for fid in attachment_ids:
             file_id = fid.strip()
@@ -215,37 +395,88 @@ def extract_urls(email, directory):
 
             # Get file metadata and signed URL
             try:
-                res = requests.get(
-                    f"https://api.hubapi.com/files/v3/files/{file_id}/signed-url",
-                    headers=headers,
-                )
-                res.raise_for_status()
-                data = res.json()
-                url = data.get("url")
-                name = data.get("name", f"file_{file_id}")
-                filename = f'{name}.{data.get("extension", "pdf")}'
-
+                url, filename = signed_url(file_id)
                 if not url:
                     print(f"  → No signed URL for {file_id}")
                     continue
 
-                # Download file
-                f_res = requests.get(url)
-                f_res.raise_for_status()
+                if not (parse_files and is_notice_file(filename)):
+                    # download later if the notice is still open
+                    deferred.append({"id": file_id, "name": filename})
+                    continue
+
                 # Create email-specific directory
                 os.makedirs(email_dir, exist_ok=True)
-                filename = os.path.join(email_dir, filename)
-
-                with open(filename, "wb") as out:
-                    out.write(f_res.content)
-                print(f"  → Downloaded {name}")
+                download_file(url, os.path.join(email_dir, filename))
             except requests.exceptions.HTTPError as err:
                 print(f"  → Failed to download file {file_id}: {err}")
                 continue
 
+        save_deferred(email_dir, {"files": deferred})
+        if parse_files:
+            report_duplicate(email_dir)
+
+
+def report_duplicate(email_dir):
+    """Fingerprint the downloaded notices, a notice seen before is not processed again"""
+    original = fingerprints.add_files(email_dir, is_notice_file)
+    if original:
+        print(f"  → Duplicate of {original}")
 
-def unzip_files(filename):
-    """Unzip downloaded zip file"""
+
+def signed_url(file_id):
+    """Get the signed download url and file name of a hubspot attachment"""
+    res = hubspot.get(f"/files/v3/files/{file_id}/signed-url")
+    data = res.json()
+    name = data.get("name", f"file_{file_id}")
+    return data.get("url"), f'{name}.{data.get("extension", "pdf")}'
+
+
+def download_file(url, filename):
+    """Download a url to a local file"""
+    f_res = requests.get(url)
+    f_res.raise_for_status()
+
+    with open(filename, "wb") as out:
+        out.write(f_res.content)
+    print(f"  → Downloaded {os.path.basename(filename)}")
+
+
+def fetch_deferred(email_dir):
+    """Download the attachments that were deferred until the email is uploaded"""
+    deferred = load_deferred(email_dir)
+    if not deferred:
+        return
+
+    if deferred.get("zip"):
+        try:
+            filename = os.path.join(email_dir, "attachments.zip")
+            if not os.path.exists(filename):
+                download_file(deferred["zip"], filename)
+            unzip_files(filename)
+            deferred.pop("zip")
+        except Exception as e:
+            print(f"  → Failed to download {deferred['zip']}: {e}")
+
+    remaining = []
+    for attachment in deferred.get("files", []):
+        try:
+            url, filename = signed_url(attachment["id"])
+            if not url:
+                print(f"  → No signed URL for {attachment['id']}")
+                continue
+            download_file(url, os.path.join(email_dir, filename))
+        except Exception as err:
+            # connection errors, timeouts and a used up budget too, the rest still download
+            print(f"  → Failed to download file {attachment['id']}: {err}")
+            remaining.append(attachment)
+    deferred["files"] = remaining
+
+    save_deferred(email_dir, deferred)
+
+
+def unzip_files(filename, include=None):
+    """Unzip downloaded zip file, optionally only the members whose name matches include"""
     if not os.path.exists(filename):
         return
 
@@ -266,26 +497,6 @@ def unzip_files(filename):
             if any("/" in m for m in members):
                 strip_top_level = True
 
-        # Build list of target paths (after optional stripping) and check if already present
-        targets = []
-        for m in members:
-            target_rel = m
-            if strip_top_level:
-                # remove leading "top_level/" prefix
-                if m.startswith(top_level + "/"):
-                    target_rel = m[len(top_level) + 1 :]
-                else:
-                    # unexpected - keep as-is
-                    target_rel = m
-            if not target_rel:
-                continue
-            target_path = os.path.normpath(os.path.join(extract_dir, target_rel))
-            targets.append(target_path)
-
-        # If any of the targets already exist, assume archive already extracted -> do nothing
-        if any(os.path.exists(t) for t in targets):
-            return
-
         # Safe extraction: avoid zip-slip by validating final path starts with extract_dir
         for zi in z.infolist():
             m = zi.filename
@@ -312,6 +523,13 @@ def unzip_files(filename):
                 os.makedirs(dest_path, exist_ok=True)
                 continue
 
+            if include is not None and not include(m_rel):
+                continue
+
+            # already extracted
+            if os.path.exists(dest_path):
+                continue
+
             # ensure parent dir exists
             parent = os.path.dirname(dest_path)
             if parent:
@@ -0,0 +1,198 @@
+"""Local mirror of the drive folder tree under PARENT_FOLDER_ID, kept fresh with the changes api"""
+
+import os
+import json
+import hashlib
+import threading
+
+PARENT_FOLDER_ID = os.environ.get("PARENT_FOLDER_ID")
+INDEX_FILE = "drive_index.json"
+FOLDER_MIME = "application/vnd.google-apps.folder"
+FILE_FIELDS = "id, name, mimeType, parents, md5Checksum, trashed"
+# folders listed per files query, the query string has a length limit
+FOLDERS_PER_QUERY = 50
+
+
+def file_md5(path):
+    """md5 of a local file, as drive reports in md5Checksum"""
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DriveIndex:
+    """
+    Folders under the parent folder and the files in each, with their md5s.
+
+    The first sync lists the whole tree, later syncs only apply the changes
+    since the stored changes page token. Lookups are local, so checking if a
+    folder or file exists needs no drive calls.
+    """
+
+    def __init__(self, parent_id=PARENT_FOLDER_ID, index_file=INDEX_FILE):
+        self.parent_id = parent_id
+        self.index_file = index_file
+        self.page_token = None
+        # folder id -> {"name": str, "files": {file id: {"name": str, "md5": str}}}
+        self.folders = {}
+        self.synced = False
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        try:
+            if os.path.exists(self.index_file):
+                with open(self.index_file, "r") as f:
+                    data = json.load(f)
+                if data.get("parent_id") == self.parent_id:
+                    self.page_token = data.get("page_token")
+                    self.folders = data.get("folders", {})
+        except:
+            pass
+
+    def save(self):
+        with self._lock:
+            data = {
+                "parent_id": self.parent_id,
+                "page_token": self.page_token,
+                "folders": self.folders,
+            }
+            tmp_file = self.index_file + ".tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_file, self.index_file)
+
+    def folder_id(self, name):
+        """Id of the folder with this name, or None"""
+        with self._lock:
+            for folder_id, folder in self.folders.items():
+                if folder["name"] == name:
+                    return folder_id
+        return None
+
+    def file_id(self, folder_id, name):
+        """Id of the file with this name in the folder, or None"""
+        with self._lock:
+            for file_id, entry in self.folders.get(folder_id, {}).get("files", {}).items():
+                if entry["name"] == name:
+                    return file_id
+        return None
+
+    def folder_with_md5(self, md5):
+        """Id of a folder that already holds a file with this md5, or None"""
+        with self._lock:
+            for folder_id, folder in self.folders.items():
+                if any(entry.get("md5") == md5 for entry in folder["files"].values()):
+                    return folder_id
+        return None
+
+    def add_folder(self, folder_id, name):
+        with self._lock:
+            self.folders.setdefault(folder_id, {"name": name, "files": {}})["name"] = name
+
+    def add_file(self, folder_id, file_id, name, md5=None):
+        with self._lock:
+            if folder_id in self.folders:
+                self.folders[folder_id]["files"][file_id] = {"name": name, "md5": md5}
+
+    def remove(self, file_id):
+        """Remove a folder or file from the index"""
+        with self._lock:
+            self.folders.pop(file_id, None)
+            for folder in self.folders.values():
+                folder["files"].pop(file_id, None)
+
+    def apply(self, item):
+        """Update the index from a drive file resource"""
+        if item.get("trashed"):
+            self.remove(item["id"])
+            return
+        parents = item.get("parents") or []
+        if item.get("mimeType") == FOLDER_MIME:
+            if self.parent_id in parents:
+                self.add_folder(item["id"], item["name"])
+            else:
+                self.remove(item["id"])
+            return
+
+        with self._lock:
+            # moved files are removed from their old folder
+            for folder_id, folder in self.folders.items():
+                if folder_id not in parents:
+                    folder["files"].pop(item["id"], None)
+            for folder_id in parents:
+                self.add_file(folder_id, item["id"], item["name"], item.get("md5Checksum"))
+
+    def sync(self, service):
+        """Bring the index up to date, at most once per run"""
+        with self._lock:
+            if self.synced:
+                return
+            if self.page_token:
+                self._apply_changes(service)
+            else:
+                self._rebuild(service)
+            self.synced = True
+            self.save()
+
+    def refresh(self):
+        """Apply the drive changes again on the next sync, for long running processes"""
+        with self._lock:
+            self.synced = False
+
+    def _rebuild(self, service):
+        """List the whole tree under the parent folder"""
+        print("Building the drive index...")
+        # take the token first so changes made while listing are not missed
+        self.page_token = service.changes().getStartPageToken().execute()["startPageToken"]
+        self.folders = {}
+
+        query = f"'{self.parent_id}' in parents and mimeType = '{FOLDER_MIME}' and trashed = false"
+        for item in self._list(service, query):
+            self.add_folder(item["id"], item["name"])
+
+        # list the files of many folders at once, far fewer calls than one per folder
+        folder_ids = list(self.folders)
+        for i in range(0, len(folder_ids), FOLDERS_PER_QUERY):
+            parents = " or ".join(f"'{folder_id}' in parents" for folder_id in folder_ids[i:i + FOLDERS_PER_QUERY])
+            query = f"({parents}) and mimeType != '{FOLDER_MIME}' and trashed = false"
+            for item in self._list(service, query):
+                self.apply(item)
+
+    def _list(self, service, query):
+        page_token = None
+        while True:
+            results = service.files().list(
+                q=query,
+                fields=f"nextPageToken, files({FILE_FIELDS})",
+                pageSize=1000,
+                pageToken=page_token,
+            ).execute()
+            yield from results.get("files", [])
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                break
+
+    def _apply_changes(self, service):
+        """Apply the changes since the stored page token"""
+        page_token = self.page_token
+        while page_token:
+            results = service.changes().list(
+                pageToken=page_token,
+                fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({FILE_FIELDS}))",
+                pageSize=1000,
+            ).execute()
+            for change in results.get("changes", []):
+                if change.get("removed") or not change.get("file"):
+                    self.remove(change["fileId"])
+                else:
+                    self.apply(change["file"])
+            if "newStartPageToken" in results:
+                self.page_token = results["newStartPageToken"]
+            page_token = results.get("nextPageToken")
+
+
+# shared index for the uploads in this run
+index = DriveIndex()
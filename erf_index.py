@@ -0,0 +1,199 @@
+"""Resolve erf numbers to street addresses and centroids from an offline cadastral extract"""
+
+import os
+import re
+import csv
+import pickle
+import argparse
+import threading
+from array import array
+
+# cadastral extract with erf, address, suburb, latitude and longitude columns
+ERF_CSV = os.environ.get("ERF_CSV", "cadastre.csv")
+# the compiled index, rebuilt when the csv changes
+ERF_INDEX_FILE = "erf_index.pickle"
+# erf numbers above this aren't indexed, the slot array would get too big
+MAX_ERF = 4_000_000
+
+_ERF_RE = re.compile(r"\berf\s+(?:no\.?\s*)?(\d+)", re.IGNORECASE)
+_LEADING_NUMBER_RE = re.compile(r"\d+")
+
+
+def erf_numbers(text):
+    """The erf numbers mentioned in a text, like 'Erf 1234' or 'ERF No. 1234'"""
+    found = []
+    for match in _ERF_RE.finditer(text or ""):
+        erf = int(match.group(1))
+        if erf not in found:
+            found.append(erf)
+    return found
+
+
+class ErfIndex:
+    """
+    Erf number -> street address, suburb and centroid.
+
+    Rows are sorted by erf and kept in flat arrays, with a slot array indexed
+    by the erf number holding the first row of each erf, so a lookup is two
+    array reads. Erf numbers repeat across suburbs, those rows are
+    consecutive and picked between with the suburb named in the notice.
+    """
+
+    def __init__(self, csv_file=ERF_CSV, index_file=ERF_INDEX_FILE):
+        self.csv_file = csv_file
+        self.index_file = index_file
+        self.erfs = array("l")
+        self.slots = array("l")
+        self.latitudes = array("d")
+        self.longitudes = array("d")
+        self.addresses = []
+        self.suburbs = []
+        self._suburb_re = None
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load the compiled index, compiling the csv first when it is newer"""
+        with self._lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            if not os.path.exists(self.csv_file):
+                return
+            try:
+                with open(self.index_file, "rb") as f:
+                    data = pickle.load(f)
+                if data.pop("source") == self._source():
+                    self.__dict__.update(data)
+                    return
+            except (OSError, KeyError, pickle.UnpicklingError, EOFError):
+                pass
+            self._build()
+
+    def _source(self):
+        # the compiled index is for this version of this csv
+        return os.path.abspath(self.csv_file), os.path.getmtime(self.csv_file), os.path.getsize(self.csv_file)
+
+    def _build(self):
+        rows = []
+        with open(self.csv_file, newline="", encoding="utf-8-sig") as f:
+            for row in csv.DictReader(f):
+                match = _LEADING_NUMBER_RE.match((row.get("erf") or "").strip())
+                if not match or int(match.group()) > MAX_ERF:
+                    continue
+                try:
+                    latitude, longitude = float(row["latitude"]), float(row["longitude"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                rows.append((
+                    int(match.group()), (row.get("address") or "").strip(),
+                    (row.get("suburb") or "").strip(), latitude, longitude,
+                ))
+        rows.sort(key=lambda row: row[0])
+
+        # suburbs repeat, share their strings
+        suburbs = {}
+        self.erfs = array("l", (row[0] for row in rows))
+        self.addresses = [row[1] for row in rows]
+        self.suburbs = [suburbs.setdefault(row[2], row[2]) for row in rows]
+        self.latitudes = array("d", (row[3] for row in rows))
+        self.longitudes = array("d", (row[4] for row in rows))
+        self.slots = array("l", [-1]) * ((self.erfs[-1] + 1) if rows else 0)
+        for i in range(len(rows) - 1, -1, -1):
+            self.slots[self.erfs[i]] = i
+
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump({
+                "source": self._source(),
+                "erfs": self.erfs, "slots": self.slots, "latitudes": self.latitudes,
+                "longitudes": self.longitudes, "addresses": self.addresses, "suburbs": self.suburbs,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.index_file)
+        print(f"Indexed {len(rows)} erfs from {self.csv_file}")
+
+    def __len__(self):
+        self.load()
+        return len(self.erfs)
+
+    def named_suburbs(self, text):
+        """The indexed suburbs named in a text, lowercased"""
+        self.load()
+        if self._suburb_re is None:
+            names = sorted({suburb.lower() for suburb in self.suburbs if suburb}, key=len, reverse=True)
+            pattern = "|".join(re.escape(name) for name in names) or "(?!)"
+            self._suburb_re = re.compile(rf"\b(?:{pattern})\b")
+        return set(self._suburb_re.findall((text or "").lower()))
+
+    def lookup(self, erf, hint=""):
+        """
+        {"address", "suburb", "coordinates"} of an erf, or None.
+
+        When hint names suburbs the erf must be in one of them. When the erf
+        number is in several suburbs and hint names none of them, or several
+        that have it, None is returned.
+        """
+        self.load()
+        if not 0 <= erf < len(self.slots) or self.slots[erf] < 0:
+            return None
+        first = last = self.slots[erf]
+        while last + 1 < len(self.erfs) and self.erfs[last + 1] == erf:
+            last += 1
+        rows = range(first, last + 1)
+        named = self.named_suburbs(hint)
+        if named:
+            rows = [i for i in rows if self.suburbs[i].lower() in named]
+        if len(rows) != 1:
+            return None
+        row = rows[0]
+        return {
+            "address": self.addresses[row],
+            "suburb": self.suburbs[row],
+            "coordinates": {"latitude": self.latitudes[row], "longitude": self.longitudes[row]},
+        }
+
+    def resolve(self, *texts):
+        """The first erf in the texts that the index knows, as lookup returns it"""
+        hint = " ".join(text or "" for text in texts)
+        for text in texts:
+            for erf in erf_numbers(text):
+                entry = self.lookup(erf, hint)
+                if entry:
+                    return entry
+        return None
+
+
+# shared index, loaded on first lookup
+index = ErfIndex()
+
+
+def erf_address(address, *texts):
+    """
+    The address, or when it is empty the address of the first known erf in
+    the texts, with the erf's centroid seeded into the coordinates cache so
+    it isn't geocoded. Empty when there is neither.
+    """
+    from address_normalizer import normalise_address
+    from address_to_pin import seed_coordinates
+
+    # an address from the pdf is kept, the erf in the subject may be a neighbouring one
+    if address:
+        return address
+    entry = index.resolve(*texts)
+    if not entry or not entry["address"]:
+        return ""
+    address = normalise_address(", ".join(p for p in (entry["address"], entry["suburb"]) if p))
+    seed_coordinates(address, entry["coordinates"])
+    return address
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the erf index or look up erfs")
+    parser.add_argument("text", nargs="*", help="text with erf numbers, like 'Erf 1234 Gardens'")
+    parser.add_argument("--csv", default=ERF_CSV, help="cadastral extract to index")
+    args = parser.parse_args()
+
+    erf_index = ErfIndex(args.csv)
+    print(f"{len(erf_index)} erfs indexed")
+    for text in args.text:
+        print(f"{text}: {erf_index.resolve(text)}")
@@ -0,0 +1,83 @@
+"""Take points off the map the day they expire, without parsing their notices again"""
+
+import os
+import argparse
+from datetime import date, timedelta
+from download_emails import NOTICE_DIR, PUBLIC_DIR, EVENTS_DIR
+from process_documents import is_expired, EXPIRY_GRACE_DAYS
+from records_store import store as default_store
+from retention import expire
+from export_map_data import export_to_map_csv, export_geojson_tiles
+
+DIRECTORIES = {"notice": NOTICE_DIR, "public": PUBLIC_DIR, "events": EVENTS_DIR}
+
+
+class ExpiryQueue:
+    """
+    Records of every exported item, ordered by closing (or event end) date.
+
+    The records store keeps them in its closing date index, so the queue
+    persists between runs and the next item to expire is always at the front.
+    Popping the expired items needs no pdf parsing.
+    """
+
+    def __init__(self, store=default_store, grace_days=EXPIRY_GRACE_DAYS):
+        self.store = store
+        self.grace_days = grace_days
+
+    def next_expiry(self):
+        """The day the next item expires, or None when nothing will"""
+        closing = self.store.next_closing()
+        if not closing:
+            return None
+        return date.fromisoformat(closing) + timedelta(days=self.grace_days)
+
+    def pop_expired(self):
+        """Remove the expired records from the store and return them"""
+        cutoff = date.today() - timedelta(days=self.grace_days)
+        expired = [
+            record for record in self.store.expiring(cutoff)
+            if is_expired(date.fromisoformat(record.closing), self.grace_days)
+        ]
+        by_category = {}
+        for record in expired:
+            by_category.setdefault(record.category, []).append(record.key)
+        for category, keys in by_category.items():
+            self.store.remove(category, keys)
+        return expired
+
+    def run_due(self, export=True, geojson=False):
+        """
+        Take the expired items off the map and delete their email folders.
+        Only the categories that lost items are exported again.
+        """
+        expired = self.pop_expired()
+        for record in expired:
+            print(f"{record.email_id}: EXPIRED - closed {record.closing_date}, {record.title}")
+            if record.email_id:
+                expire(
+                    os.path.join(DIRECTORIES[record.category], record.email_id),
+                    date.fromisoformat(record.closing),
+                )
+
+        categories = sorted({record.category for record in expired})
+        if export:
+            for category in categories:
+                data = self.store.items(category)
+                export_to_map_csv(category, data)
+                if geojson:
+                    export_geojson_tiles(category, data)
+        return expired
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remove the expired points from the map")
+    parser.add_argument(
+        "--geojson", action="store_true",
+        help="also export the geojson tiles of the changed categories",
+    )
+    args = parser.parse_args()
+
+    queue = ExpiryQueue()
+    expired = queue.run_due(geojson=args.geojson)
+    print(f"{len(expired)} items expired, next expiry {queue.next_expiry() or 'none'}")
@@ -1,6 +1,12 @@
 """Export map json data to kml or csv format for google my maps"""
 
 import csv
+import io
+import os
+import json
+import math
+import hashlib
+import zipfile
 from address_to_pin import get_coordinates
 from datetime import date
 from xml.sax.saxutils import escape
@@ -8,7 +14,7 @@ from xml.sax.saxutils import escape
 kml_header = """<?xml version="1.0" encoding="UTF-8"?>
 <kml xmlns="http://www.opengis.net/kml/2.2">
   <Document>
-    <name>map_points_2025-10-19.kml</name>
+    <name>{name}</name>
     <Style id="icon-1502-0F9D58-normal">
       <IconStyle>
         <color>ff589d0f</color>
@@ -45,70 +51,206 @@ kml_header = """<?xml version="1.0" encoding="UTF-8"?>
     </StyleMap>
 """
 
-kml_footer = "</Document>\n</kml>"
+kml_footer = "  </Document>\n</kml>\n"
 
+kml_placemark = """      <Placemark>
+        <name>{name}</name>
+        <description><![CDATA[{description}]]></description>
+        <styleUrl>#icon-1502-0F9D58</styleUrl>
+        <ExtendedData>
+          <Data name="description">
+            <value><![CDATA[{extended_description}]]></value>
+          </Data>
+          <Data name="address">
+            <value>{address}</value>
+          </Data>
+        </ExtendedData>
+        {location}
+      </Placemark>
+"""
 
-def export_to_map1_kml():
-    """Export map data in kml format"""
-    document_data = process_all_attachments()
-    map_data = []
-    kml_filename = f"map_points_{date.today().isoformat()}.kml"
 
-    with open(kml_filename, "w", encoding="utf-8") as f:
-        f.write(kml_header)
+def _cdata(text):
+    """Make text safe to place inside a CDATA section"""
+    return str(text or "").replace("]]>", "]]]]><![CDATA[>")
 
-        for item in document_data:
+
+def kml_placemark_entry(item):
+    """Build the kml placemark for an item, with point coordinates when the address is geocoded"""
+    address = item["address"]
+    # Format description with newline between items and clickable link
+    description_lines = [
+        escape(item.get("description", "") or ""),
+        f"Close date: {escape(item.get('closing_date', '') or '')}",
+        f'<a href="{escape(item.get("file_link", "") or "")}">View Application</a>',
+        f"address: {escape(address)}",
+    ]
+    extended_description = (
+        f'{item.get("description", "") or ""}\n'
+        f'Close date: {item.get("closing_date", "") or ""}\n'
+        f'View Application: {item.get("file_link", "") or ""}'
+    )
+
+    # pre-geocoded points save google from geocoding every placemark on import
+    coordinates = item.get("coordinates") or get_coordinates(address)
+    if coordinates:
+        location = (
+            f"<Point><coordinates>{coordinates['longitude']:.6f},"
+            f"{coordinates['latitude']:.6f},0</coordinates></Point>"
+        )
+    else:
+        location = f"<address>{escape(address)}</address>"
+
+    return kml_placemark.format(
+        name=escape(item.get("title", "") or ""),
+        description=_cdata("<br/>".join(description_lines)),
+        extended_description=_cdata(extended_description),
+        address=escape(address),
+        location=location,
+    )
+
+
+def write_kml(out, categories, name):
+    """
+    Stream kml to a text file object.
+
+    categories is an iterable of (category name, items) pairs, each written as
+    a folder layer. Items are written as they arrive so only one placemark is
+    held in memory at a time.
+    """
+    count = 0
+    out.write(kml_header.format(name=escape(name)))
+    for category, items in categories:
+        out.write(f"    <Folder>\n      <name>{escape(category)}</name>\n")
+        for item in items:
             if not item.get("address"):
                 # do not process emails without address
                 print("ERROR no address", item)
                 continue
-            # Format description with newline between items and clickable link
-            description_lines = [
-                escape(item.get("description", "")),
-                f"Close date: {escape(item.get('closing_date', ''))}",
-                f'<a href="{escape(item.get("file_link", ""))}">View Application</a>',
-            ]
-            description_html = "<br/>".join(description_lines)
-
-            extended_description = (
-                f'{escape(item.get("description", ""))}\n'
-                f'Close date: {escape(item.get("closing_date", ""))}\n'
-                f'View Application: {escape(item.get("file_link", ""))}'
-            )
-
-            kml_entry = f"""
-                    <Placemark>
-                    <name>{item['title']}</name>
-                    <address>{escape(item['address'])}</address>
-                    <description><![CDATA[{description_html}<br>address: {escape(item['address'])}]]></description>
-                    <styleUrl>#icon-1502-0F9D58</styleUrl> 
-                    <ExtendedData>
-                        <Data name="description">
-                        <value><![CDATA[{extended_description}]]></value>
-                        </Data>
-                        <Data name="address">
-                        <value>{escape(item['address'])}</value>
-                        </Data>
-                    </ExtendedData>
-                    </Placemark>
-                """
-
-            f.write(kml_entry)
-        f.write(kml_footer)
-
-    print(f"Map saved to {kml_filename}")
-
-
-def export_to_map_csv(filename, document_data):
+            out.write(kml_placemark_entry(item))
+            count += 1
+        out.write("    </Folder>\n")
+    out.write(kml_footer)
+    return count
+
+
+def export_to_map1_kml(categories=None, kmz=False):
+    """
+    Export map data in kml format, or zipped kmz.
+
+    categories is an iterable of (category name, items) pairs, by default the
+    records of every category are read from the records store.
+    """
+    if categories is None:
+        from records_store import store, CATEGORIES
+
+        categories = [(category, store.items(category)) for category in CATEGORIES]
+
+    name = f"map_points_{date.today().isoformat()}.kml"
+    if kmz:
+        kml_filename = f"map_points_{date.today().isoformat()}.kmz"
+        with zipfile.ZipFile(kml_filename, "w", zipfile.ZIP_DEFLATED) as z:
+            # google expects the main document to be doc.kml in the archive
+            with z.open("doc.kml", "w") as raw:
+                with io.TextIOWrapper(raw, encoding="utf-8") as f:
+                    count = write_kml(f, categories, name)
+    else:
+        kml_filename = name
+        with open(kml_filename, "w", encoding="utf-8") as f:
+            count = write_kml(f, categories, name)
+
+    print(f"Map saved to {kml_filename} ({count} points)")
+
+
+CSV_HEADERS = ["Address", "Title", "Description", "Closing Date", "View Application"]
+EXPORT_STATE_DIR = "export_state"
+
+
+def item_key(item):
+    """Stable key for an exported item, the email it was extracted from"""
+    if item.get("email_id"):
+        return str(item["email_id"])
+    return f'{item.get("address", "")}|{item.get("title", "")}'
+
+
+def item_row(item):
+    """The csv row for an item"""
+    return [
+        item.get("address", "") or "",
+        item.get("title", "") or "",
+        item.get("description", "") or "",
+        item.get("closing_date", "") or "",
+        item.get("file_link", "") or "",
+    ]
+
+
+def load_export_state(category):
+    """Load the rows last exported for a category, keyed by item key in export order"""
+    state_file = os.path.join(EXPORT_STATE_DIR, f"{category}.json")
+    try:
+        if os.path.exists(state_file):
+            with open(state_file, "r") as f:
+                return json.load(f)
+    except:
+        pass
+    return {}
+
+
+def save_export_state(category, state):
+    """Save the exported rows for a category"""
+    os.makedirs(EXPORT_STATE_DIR, exist_ok=True)
+    state_file = os.path.join(EXPORT_STATE_DIR, f"{category}.json")
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_file, state_file)
+
+
+def diff_export_state(previous, document_data):
+    """
+    Compare the items against the last exported rows.
+
+    Returns the new state and the added, changed and removed rows. Rows that
+    were exported before keep their position, new rows are appended.
+    """
+    current = {}
+    for item in document_data:
+        if not item.get("address"):
+            # do not process points without addresses
+            print("ERROR no address", item)
+            continue
+        current[item_key(item)] = item_row(item)
+
+    state = {}
+    changed = []
+    removed = []
+    for key, row in previous.items():
+        if key not in current:
+            removed.append(row)
+            continue
+        state[key] = current[key]
+        if current[key] != row:
+            changed.append(current[key])
+
+    added = []
+    for key, row in current.items():
+        if key not in previous:
+            state[key] = row
+            added.append(row)
+
+    return state, added, changed, removed
+
+
+def export_to_map_csv(filename, document_data, incremental=False, snapshot=True):
     """Export map data as csv"""
+    if incremental:
+        return export_delta_csv(filename, document_data, snapshot)
 
     csv_filename = f"{filename}_{date.today().isoformat()}.csv"
-    # Define the CSV headers.
-    csv_headers = ["Address", "Title", "Description", "Closing Date", "View Application"]
 
     with open(csv_filename, "w", encoding="utf-8", newline="") as f:
         writer = csv.writer(f)
-        writer.writerow(csv_headers)
+        writer.writerow(CSV_HEADERS)
 
         for item in document_data:
             if not item.get("address"):
@@ -116,13 +258,164 @@ def export_to_map_csv(filename, document_data):
                 print("ERROR no address", item)
                 continue
 
-            title = item.get("title", "")
-            address = item.get("address", "")
-            description = item.get("description", "")
-            closing_date = item.get("closing_date", "")
-            view_application_link = item.get("file_link", "")
-
             # Write the row to the CSV file
-            writer.writerow([address, title, description, closing_date, view_application_link])
+            writer.writerow(item_row(item))
 
     print(f"Map data saved to {csv_filename}")
+
+
+def export_delta_csv(filename, document_data, snapshot=True):
+    """
+    Export only the rows that changed since the last export of this category.
+
+    The delta csv has an extra Change column (added, changed or removed) so only
+    those rows need to be re-imported. A full snapshot in the same stable row
+    order is written alongside when snapshot is set.
+    """
+    previous = load_export_state(filename)
+    state, added, changed, removed = diff_export_state(previous, document_data)
+    today = date.today().isoformat()
+
+    if added or changed or removed:
+        delta_filename = f"{filename}_{today}_delta.csv"
+        with open(delta_filename, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_HEADERS + ["Change"])
+            for change, rows in (("removed", removed), ("changed", changed), ("added", added)):
+                for row in rows:
+                    writer.writerow(row + [change])
+        print(
+            f"Map delta saved to {delta_filename}: "
+            f"{len(added)} added, {len(changed)} changed, {len(removed)} removed"
+        )
+    else:
+        print(f"No changes to {filename} map data")
+
+    if snapshot:
+        csv_filename = f"{filename}_{today}.csv"
+        with open(csv_filename, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_HEADERS)
+            writer.writerows(state.values())
+        print(f"Map data saved to {csv_filename}")
+
+    save_export_state(filename, state)
+
+
+TILES_DIR = "tiles"
+TILE_ZOOM = 14
+# 5 decimal places is about 1m, plenty for a pin
+COORD_PRECISION = 5
+# short geojson property keys to keep the tiles small
+TILE_PROPERTY_KEYS = {
+    "t": "title",
+    "a": "address",
+    "d": "description",
+    "c": "closing_date",
+    "l": "file_link",
+}
+
+
+def tile_for(latitude, longitude, zoom):
+    """Slippy map tile x, y containing a point"""
+    n = 2 ** zoom
+    x = int((longitude + 180.0) / 360.0 * n)
+    lat_rad = math.radians(latitude)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def _write_if_changed(path, content):
+    """Write the file only when its content differs, returns whether it was written"""
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            if f.read() == content:
+                return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+    return True
+
+
+def export_geojson_tiles(category, document_data, zoom=TILE_ZOOM, tiles_dir=TILES_DIR):
+    """
+    Export geocoded items as geojson bucketed into z/x/y slippy map tiles.
+
+    Tiles are written to tiles/<category>/<z>/<x>/<y>.geojson with a
+    manifest.json listing every tile, its point count and content hash. Only
+    tiles whose content changed are rewritten, and tiles that no longer have
+    any points are removed.
+    """
+    category_dir = os.path.join(tiles_dir, category)
+    manifest_file = os.path.join(category_dir, "manifest.json")
+
+    buckets = {}
+    for item in document_data:
+        if not item.get("address"):
+            # do not process points without addresses
+            print("ERROR no address", item)
+            continue
+        coordinates = item.get("coordinates") or get_coordinates(item["address"])
+        if not coordinates:
+            continue
+
+        latitude = round(coordinates["latitude"], COORD_PRECISION)
+        longitude = round(coordinates["longitude"], COORD_PRECISION)
+        properties = {
+            key: item[field] for key, field in TILE_PROPERTY_KEYS.items() if item.get(field)
+        }
+        feature = {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [longitude, latitude]},
+            "properties": properties,
+        }
+        tile = "{}/{}/{}".format(zoom, *tile_for(latitude, longitude, zoom))
+        buckets.setdefault(tile, []).append((item_key(item), feature))
+
+    previous_tiles = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, "r") as f:
+            previous_tiles = json.load(f).get("tiles", {})
+
+    tiles = {}
+    written = 0
+    for tile in sorted(buckets):
+        # sort by item key so the tile content only changes when its items do
+        features = [feature for _, feature in sorted(buckets[tile], key=lambda f: f[0])]
+        content = json.dumps(
+            {"type": "FeatureCollection", "features": features},
+            separators=(",", ":"),
+            ensure_ascii=False,
+        ).encode("utf-8")
+        tiles[tile] = {
+            "count": len(features),
+            "hash": hashlib.sha1(content).hexdigest()[:12],
+        }
+        if _write_if_changed(os.path.join(category_dir, f"{tile}.geojson"), content):
+            written += 1
+
+    # remove tiles that no longer have points
+    removed = 0
+    for tile in previous_tiles:
+        if tile not in tiles:
+            tile_file = os.path.join(category_dir, f"{tile}.geojson")
+            if os.path.exists(tile_file):
+                os.remove(tile_file)
+                removed += 1
+
+    manifest = {
+        "category": category,
+        "zoom": zoom,
+        "properties": TILE_PROPERTY_KEYS,
+        "tiles": tiles,
+    }
+    _write_if_changed(
+        manifest_file, json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8")
+    )
+
+    print(
+        f"Map tiles saved to {category_dir}: {len(tiles)} tiles, "
+        f"{written} updated, {removed} removed"
+    )
@@ -0,0 +1,175 @@
+"""Find notices that were sent more than once, by attachment hash and description simhash"""
+
+import os
+import re
+import json
+import hashlib
+import threading
+from pdf_watchdog import file_hash
+
+FINGERPRINTS_FILE = "fingerprints.json"
+SIMHASH_BITS = 64
+# descriptions within this many differing bits are the same notice
+MAX_DISTANCE = 8
+# the simhash is split into bands, two hashes within MAX_DISTANCE bits share
+# at least one band exactly, so only emails in a shared band are compared
+BANDS = MAX_DISTANCE + 1
+BAND_BITS = SIMHASH_BITS // BANDS
+# shorter descriptions are too generic to compare
+MIN_WORDS = 20
+SHINGLE_SIZE = 3
+
+_WORD_RE = re.compile(r"\w+")
+_NUMBER_RE = re.compile(r"\d+")
+
+
+def simhash(text):
+    """64 bit simhash of the word shingles of the text"""
+    words = _WORD_RE.findall(text.lower())
+    shingles = {
+        " ".join(words[i:i + SHINGLE_SIZE])
+        for i in range(max(1, len(words) - SHINGLE_SIZE + 1))
+    }
+    counts = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        h = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            counts[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit, count in enumerate(counts) if count > 0)
+
+
+def numbers(text):
+    """The numbers in a text, notices for different erfs often only differ in those"""
+    return " ".join(sorted(set(_NUMBER_RE.findall(text))))
+
+
+def _bands(value):
+    mask = (1 << BAND_BITS) - 1
+    return [(band, value >> (band * BAND_BITS) & mask) for band in range(BANDS)]
+
+
+class FingerprintIndex:
+    """
+    Fingerprints of the emails seen so far.
+
+    Attachments are hashed when they are downloaded, an email with an
+    attachment already seen in another email is a duplicate of it. Emails
+    with different files are compared by the simhash of their description
+    text, looked up in an in-memory index of the simhash bands.
+    """
+
+    def __init__(self, fingerprints_file=FINGERPRINTS_FILE):
+        self.fingerprints_file = fingerprints_file
+        # attachment sha256 -> email folder it was first seen in
+        self.files = {}
+        # email folder -> [description simhash, numbers in the description]
+        self.texts = {}
+        # duplicate email folder -> original email folder
+        self.duplicates = {}
+        self._bands = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            if os.path.exists(self.fingerprints_file):
+                with open(self.fingerprints_file, "r") as f:
+                    data = json.load(f)
+                self.files = data.get("files", {})
+                self.texts = data.get("texts", {})
+                self.duplicates = data.get("duplicates", {})
+        except:
+            pass
+        self._bands = {}
+        for path, (value, _) in self.texts.items():
+            self._index(path, value)
+
+    def save(self):
+        data = {"files": self.files, "texts": self.texts, "duplicates": self.duplicates}
+        tmp_file = self.fingerprints_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_file, self.fingerprints_file)
+
+    def _index(self, path, value):
+        for band in _bands(value):
+            self._bands.setdefault(band, set()).add(path)
+
+    def add_files(self, path, is_notice):
+        """
+        Hash the notice pdfs in an email folder and return the folder it duplicates, or None.
+        Call it when the notices are downloaded. Only the files is_notice(name) accepts
+        are hashed, generic attachments like comment forms are shared by unrelated notices.
+        """
+        path = os.path.normpath(str(path))
+        if not os.path.isdir(path):
+            return None
+        hashes = [
+            file_hash(os.path.join(path, name))
+            for name in sorted(os.listdir(path))
+            if name.lower().endswith(".pdf") and is_notice(name)
+        ]
+        with self._lock:
+            if path in self.duplicates:
+                return self.duplicates[path]
+            original = next(
+                (self.files[h] for h in hashes if self.files.get(h, path) != path), None
+            )
+            if original:
+                self.duplicates[path] = original
+                self.save()
+            elif any(h not in self.files for h in hashes):
+                for h in hashes:
+                    self.files.setdefault(h, path)
+                self.save()
+        return original
+
+    def add_text(self, path, text):
+        """Fingerprint the description of an email and return the folder it duplicates, or None"""
+        path = os.path.normpath(str(path))
+        if len(_WORD_RE.findall(text or "")) < MIN_WORDS:
+            return None
+        value = [simhash(text), numbers(text)]
+        with self._lock:
+            if path in self.duplicates:
+                return self.duplicates[path]
+            candidates = set()
+            for band in _bands(value[0]):
+                candidates |= self._bands.get(band, set())
+            candidates.discard(path)
+            matches = sorted(
+                candidate for candidate in candidates
+                if self.texts[candidate][1] == value[1]
+                and (self.texts[candidate][0] ^ value[0]).bit_count() <= MAX_DISTANCE
+            )
+            if matches:
+                self.duplicates[path] = matches[0]
+                self.save()
+            elif self.texts.get(path) != value:
+                self.texts[path] = value
+                self._index(path, value[0])
+                self.save()
+        return matches[0] if matches else None
+
+    def compact(self, live):
+        """Drop the fingerprints of email folders that no longer exist, return the orphaned duplicates"""
+        with self._lock:
+            self.files = {h: path for h, path in self.files.items() if path in live}
+            self.texts = {path: value for path, value in self.texts.items() if path in live}
+            orphans = [
+                path for path, original in self.duplicates.items()
+                if path in live and original not in live
+            ]
+            self.duplicates = {
+                path: original for path, original in self.duplicates.items()
+                if path in live and original in live
+            }
+            self.save()
+            self._bands = {}
+            for path, (value, _) in self.texts.items():
+                self._index(path, value)
+        return orphans
+
+
+# shared index so every worker sees the fingerprints added in this run
+index = FingerprintIndex()
@@ -0,0 +1,156 @@
+"""HubSpot api client with a pooled session, retries and rate limit throttling"""
+
+import os
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+API_URL = "https://api.hubapi.com"
+HUBSPOT_TOKEN = os.environ.get("HUBSPOT_APP_TOKEN")
+# maximum requests per run, so a backfill can't use up the daily allowance
+REQUEST_BUDGET = int(os.environ.get("HUBSPOT_REQUEST_BUDGET", 5000))
+MAX_RETRIES = 5
+MAX_BACKOFF = 60
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# start pacing requests when less than this fraction of the window is left
+THROTTLE_FRACTION = 0.5
+TIMEOUT = 60
+# once the daily limit is used up, try a request again after this long in case it reset
+DAILY_RECHECK_SECONDS = 3600
+
+
+class RequestBudgetExceeded(Exception):
+    pass
+
+
+class HubSpotClient:
+    """
+    Make HubSpot api requests over a pooled session.
+
+    Failed requests (429, 5xx, connection errors) are retried with jittered
+    exponential backoff, honouring Retry-After. The X-HubSpot-RateLimit-*
+    headers of each response are used to space out the next requests once
+    the window starts running low, and every request is counted against the
+    request budget.
+    """
+
+    def __init__(self, token=HUBSPOT_TOKEN, budget=REQUEST_BUDGET, pool_size=10):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+        })
+        self.budget = budget
+        self.requests_made = 0
+        self._lock = threading.Lock()
+        self._next_request_at = 0.0
+        self._spacing = 0.0
+        self._daily_remaining = None
+        self._daily_checked_at = 0.0
+
+    def reset_budget(self):
+        """Start a new run's request budget, for long running processes"""
+        with self._lock:
+            self.requests_made = 0
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def request(self, method, path, **kwargs):
+        """Make a request, retrying rate limited and failed requests"""
+        url = path if path.startswith("http") else API_URL + path
+        kwargs.setdefault("timeout", TIMEOUT)
+
+        for attempt in range(MAX_RETRIES):
+            self._wait_for_slot()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                wait = self._backoff(attempt)
+                print(f"HubSpot request failed ({e}), retrying in {wait:.1f}s...")
+                time.sleep(wait)
+                continue
+
+            self._update_rate_limit(response)
+            if response.status_code in RETRY_STATUSES and attempt < MAX_RETRIES - 1:
+                wait = self._retry_after(response) or self._backoff(attempt)
+                print(
+                    f"HubSpot returned {response.status_code}, retrying in {wait:.1f}s "
+                    f"(attempt {attempt + 1}/{MAX_RETRIES})..."
+                )
+                time.sleep(wait)
+                continue
+
+            response.raise_for_status()
+            return response
+
+    def _wait_for_slot(self):
+        """Check the budget and wait until the rate limit allows another request"""
+        with self._lock:
+            if self.requests_made >= self.budget:
+                raise RequestBudgetExceeded(f"HubSpot request budget of {self.budget} used up")
+            if self._daily_remaining is not None and self._daily_remaining <= 0:
+                if time.monotonic() - self._daily_checked_at < DAILY_RECHECK_SECONDS:
+                    raise RequestBudgetExceeded("HubSpot daily rate limit used up")
+                # the daily window may have rolled over, the response headers will tell
+                self._daily_remaining = None
+            self.requests_made += 1
+
+            # reserve the slot so concurrent callers queue up behind each other
+            now = time.monotonic()
+            start = max(now, self._next_request_at)
+            self._next_request_at = start + self._spacing
+
+        if start > now:
+            time.sleep(start - now)
+
+    def _update_rate_limit(self, response):
+        """Pace the following requests from the rate limit headers"""
+        headers = response.headers
+        try:
+            maximum = int(headers["X-HubSpot-RateLimit-Max"])
+            remaining = int(headers["X-HubSpot-RateLimit-Remaining"])
+            interval = int(headers["X-HubSpot-RateLimit-Interval-Milliseconds"]) / 1000
+        except (KeyError, ValueError):
+            maximum = remaining = interval = None
+
+        with self._lock:
+            if "X-HubSpot-RateLimit-Daily-Remaining" in headers:
+                try:
+                    self._daily_remaining = int(headers["X-HubSpot-RateLimit-Daily-Remaining"])
+                    self._daily_checked_at = time.monotonic()
+                except ValueError:
+                    pass
+
+            if not maximum:
+                return
+            if remaining < maximum * THROTTLE_FRACTION:
+                # spread the rest of the window evenly
+                self._spacing = interval / maximum
+            else:
+                self._spacing = 0.0
+            if remaining <= 1:
+                # window used up, wait for it to reset
+                self._next_request_at = max(self._next_request_at, time.monotonic() + interval)
+
+    def _retry_after(self, response):
+        try:
+            return float(response.headers.get("Retry-After", ""))
+        except ValueError:
+            return None
+
+    def _backoff(self, attempt):
+        return min(MAX_BACKOFF, 2 ** attempt) + random.uniform(0, 1)
+
+
+# shared client so every request reuses the same connections and rate limit state
+client = HubSpotClient()
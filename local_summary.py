@@ -0,0 +1,102 @@
+"""Summarise the application descriptions locally, only calling gemini for the long ones"""
+
+import re
+import os
+import threading
+from collections import Counter
+
+# descriptions this short are already a summary
+PASSTHROUGH_CHARS = int(os.environ.get("SUMMARY_PASSTHROUGH_CHARS", 300))
+PASSTHROUGH_SENTENCES = 2
+# longer descriptions, or ones with more sentences, are summarised by gemini
+EXTRACTIVE_MAX_CHARS = int(os.environ.get("SUMMARY_EXTRACTIVE_CHARS", 1200))
+EXTRACTIVE_MAX_SENTENCES = 8
+SUMMARY_SENTENCES = 2
+
+# a sentence ends before a capital or number, the lines of the pdf text were
+# joined with '. ' so a full stop before a lowercase word is a line break
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9])")
+_LINE_BREAK_RE = re.compile(r"\.\s+(?=[a-z])")
+_WORD_RE = re.compile(r"[a-z]+")
+_STOPWORDS = frozenset("""
+    a an and are as at be by for from has have in is it its of on or that the
+    this to was were which will with within into than other such any all
+""".split())
+
+counts = Counter()
+_counts_lock = threading.Lock()
+
+
+def _count(tier):
+    with _counts_lock:
+        counts[tier] += 1
+
+
+def sentences(text):
+    """The sentences of a description, with the pdf line breaks removed"""
+    text = _LINE_BREAK_RE.sub(" ", text.strip())
+    return [s.strip() for s in _SENTENCE_RE.split(text) if s.strip()]
+
+
+def extractive_summary(parts, size=SUMMARY_SENTENCES):
+    """
+    The size highest scoring sentences, in their original order.
+
+    Sentences score the mean document frequency of their content words, so
+    the ones about what most of the text is about win, and the first
+    sentence, which usually states the application, gets a bonus.
+    """
+    if len(parts) <= size:
+        return " ".join(parts)
+    words = [[w for w in _WORD_RE.findall(s.lower()) if w not in _STOPWORDS] for s in parts]
+    frequency = Counter(w for sentence in words for w in set(sentence))
+    scores = [
+        sum(frequency[w] for w in sentence) / (len(sentence) or 1) + (1 if i == 0 else 0)
+        for i, sentence in enumerate(words)
+    ]
+    best = sorted(sorted(range(len(parts)), key=lambda i: -scores[i])[:size])
+    return " ".join(parts[i] for i in best)
+
+
+def summarise(text, description_id):
+    """
+    Summarise a description in the cheapest way that fits it.
+
+    Short descriptions are returned as they are, mid-length ones get an
+    extractive summary, and only long ones are sent to gemini. When gemini
+    fails the extractive summary is used instead of losing the description.
+    """
+    if not text:
+        return text
+    parts = sentences(text)
+    length = sum(len(s) for s in parts)
+
+    if length <= PASSTHROUGH_CHARS and len(parts) <= PASSTHROUGH_SENTENCES:
+        _count("passthrough")
+        return " ".join(parts)
+    if length <= EXTRACTIVE_MAX_CHARS and len(parts) <= EXTRACTIVE_MAX_SENTENCES:
+        _count("extractive")
+        return extractive_summary(parts)
+
+    from ai_summarise_descriptions import ai_summarise_text
+
+    summary = ai_summarise_text(text, description_id)
+    if summary:
+        _count("gemini")
+        return summary
+    _count("fallback")
+    return extractive_summary(parts)
+
+
+def summary_report():
+    """Print how many descriptions each tier summarised"""
+    with _counts_lock:
+        total = sum(counts.values())
+        if not total:
+            return
+        local = total - counts["gemini"]
+        print(
+            f"Summaries: {counts['passthrough']} passed through, {counts['extractive']} extractive, "
+            f"{counts['gemini']} gemini, {counts['fallback']} fallback "
+            f"({local}/{total} summarised locally)"
+        )
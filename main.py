@@ -1,23 +1,146 @@
-from export_map_data import export_to_map_csv
+import argparse
+from export_map_data import export_to_map_csv, export_to_map1_kml, export_geojson_tiles
 from process_documents import process_all_attachments
 from process_events_documents import process_all_events
 from download_emails import list_emails, NOTICE_DIR, PUBLIC_DIR, EVENTS_DIR
+from scheduler import TaskGraph
+from cluster_points import cluster_items
+from pdf_watchdog import quarantine_report
+from upload_queue import UploadWorkers, resolve_links
+from retention import retention_due, run_retention
+from records_store import save_category
+from expiry_queue import ExpiryQueue
+from local_summary import summary_report
+from model_router import router
 
-if __name__ == "__main__":
-    # list the hubspot emails
-    list_emails()
 
-    # extract info from noticeboard attachments
-    document_data = process_all_attachments(NOTICE_DIR)
-    # export email data to csv map data
-    export_to_map_csv("notice", document_data)
+def build_pipeline(
+    incremental=False, snapshot=True, kml=False, kmz=False, geojson=False, cluster=False,
+    upload_workers=True,
+):
+    """Declare the pipeline stages and their dependencies"""
+    graph = TaskGraph()
+    directories = {"notice": NOTICE_DIR, "public": PUBLIC_DIR, "events": EVENTS_DIR}
 
-    # extract info from public participation attachments
-    document_data = process_all_attachments(PUBLIC_DIR)
-    # export email data to csv map data
-    export_to_map_csv("public", document_data)
+    # drain the drive upload queue in the background while the emails are extracted
+    if upload_workers:
+        uploads = UploadWorkers()
+        graph.add("start_uploads", uploads.start)
+        # stop the workers after the last upload, even when a stage failed
+        graph.add_cleanup(uploads.finish)
+
+    # list the hubspot emails and download the attachments
+    graph.add("download", list_emails)
 
+    # extract info from noticeboard attachments
+    graph.add("notice", lambda _: process_all_attachments(NOTICE_DIR), deps=["download"])
+    # extract info from public participation attachments
+    graph.add("public", lambda _: process_all_attachments(PUBLIC_DIR), deps=["download"])
     # extract info from events emails (parsed from subject line, no AI)
-    document_data = process_all_events(EVENTS_DIR)
-    # export email data to csv map data
-    export_to_map_csv("events", document_data)
+    graph.add("events", lambda _: process_all_events(EVENTS_DIR), deps=["download"])
+
+    sources = {}
+    for category in ("notice", "public", "events"):
+        # wait for the category's own uploads before exporting their links
+        if upload_workers:
+            graph.add(
+                f"uploads_{category}",
+                lambda data, _, directory=directories[category]: uploads.wait_for(directory) or data,
+                deps=[category, "start_uploads"],
+            )
+        # fill in the links of uploads that finished after extraction,
+        # with an external uploader the rest are picked up on the next run
+        sources[category] = f"links_{category}"
+        graph.add(
+            sources[category],
+            lambda data, directory=directories[category]: resolve_links(data, directory),
+            deps=[f"uploads_{category}"] if upload_workers else [category],
+        )
+        # keep the records, the exports read them back from the store
+        graph.add(
+            f"store_{category}",
+            lambda data, category=category: save_category(category, data),
+            deps=[sources[category]],
+        )
+        sources[category] = f"store_{category}"
+        # merge duplicate points for the same property before exporting
+        if cluster:
+            graph.add(f"cluster_{category}", cluster_items, deps=[sources[category]])
+            sources[category] = f"cluster_{category}"
+
+        # export email data to csv map data
+        graph.add(
+            f"export_{category}",
+            lambda data, category=category: export_to_map_csv(
+                category, data, incremental=incremental, snapshot=snapshot
+            ),
+            deps=[sources[category]],
+        )
+        # export tiled geojson for a browser map
+        if geojson:
+            graph.add(
+                f"tiles_{category}",
+                lambda data, category=category: export_geojson_tiles(category, data),
+                deps=[sources[category]],
+            )
+
+    # export all categories as layers of one kml map
+    if kml or kmz:
+        graph.add(
+            "export_kml",
+            lambda notice, public, events: export_to_map1_kml(
+                [("notice", notice), ("public", public), ("events", events)], kmz=kmz
+            ),
+            deps=[sources["notice"], sources["public"], sources["events"]],
+        )
+
+    return graph
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the CIBRA notification map data")
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="only export the rows that changed since the last run to a delta csv",
+    )
+    parser.add_argument(
+        "--no-snapshot", dest="snapshot", action="store_false",
+        help="with --incremental, skip writing the full csv",
+    )
+    parser.add_argument(
+        "--kml", action="store_true",
+        help="also export a kml map with a layer per category",
+    )
+    parser.add_argument(
+        "--kmz", action="store_true",
+        help="also export the kml map zipped as kmz",
+    )
+    parser.add_argument(
+        "--geojson", action="store_true",
+        help="also export geojson tiles for a browser map",
+    )
+    parser.add_argument(
+        "--cluster", action="store_true",
+        help="merge duplicate points for the same property into one point",
+    )
+    parser.add_argument(
+        "--external-uploads", dest="upload_workers", action="store_false",
+        help="only queue the drive uploads, for a separate `python upload_queue.py` worker",
+    )
+    args = parser.parse_args()
+
+    # prune expired emails and compact the caches once a day
+    if retention_due():
+        run_retention()
+    # drop the items that expired since the last run without parsing them again
+    ExpiryQueue().run_due(export=False)
+
+    build_pipeline(
+        incremental=args.incremental, snapshot=args.snapshot, kml=args.kml, kmz=args.kmz,
+        geojson=args.geojson, cluster=args.cluster, upload_workers=args.upload_workers,
+    ).run()
+
+    # pdfs that hung or crashed the parser are skipped until they change
+    quarantine_report()
+    summary_report()
+    router.report()
@@ -0,0 +1,212 @@
+"""Serve the map records as json or geojson over http, with etags and gzip"""
+
+import os
+import gzip
+import json
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from datetime import date
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from records_store import store as default_store, CATEGORIES
+
+MAP_API_PORT = int(os.environ.get("MAP_API_PORT", 8000))
+# responses kept for repeat requests, dropped when their categories change
+RESPONSE_CACHE_SIZE = 256
+# smaller bodies aren't worth compressing
+GZIP_MIN_SIZE = 512
+
+PROPERTY_FIELDS = [
+    "category", "email_id", "title", "address", "suburb", "description",
+    "closing_date", "closing", "file_link",
+]
+
+
+class BadRequest(Exception):
+    pass
+
+
+def record_properties(record):
+    return {field: getattr(record, field) for field in PROPERTY_FIELDS}
+
+
+def record_feature(record):
+    if record.latitude is None or record.longitude is None:
+        return None
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [record.longitude, record.latitude]},
+        "properties": record_properties(record),
+    }
+
+
+def parse_filters(query):
+    """Filters from the query string: category, from, to, bbox and all"""
+    categories = []
+    for value in query.get("category", []):
+        categories.extend(c for c in value.split(",") if c)
+    unknown = [c for c in categories if c not in CATEGORIES]
+    if unknown:
+        raise BadRequest(f"unknown category {', '.join(unknown)}")
+
+    bbox = None
+    if query.get("bbox"):
+        try:
+            bbox = tuple(float(v) for v in query["bbox"][0].split(","))
+        except ValueError:
+            bbox = ()
+        if len(bbox) != 4:
+            raise BadRequest("bbox is min_lon,min_lat,max_lon,max_lat")
+
+    dates = []
+    for name in ("from", "to"):
+        value = query.get(name, [None])[0]
+        if value:
+            try:
+                value = date.fromisoformat(value).isoformat()
+            except ValueError:
+                raise BadRequest(f"{name} is yyyy-mm-dd")
+        dates.append(value)
+
+    include_closed = query.get("all", ["0"])[0] not in ("", "0", "false")
+    return tuple(categories or CATEGORIES), dates[0], dates[1], bbox, include_closed
+
+
+class MapData:
+    """
+    Encoded responses built from the records store.
+
+    Each category's records are loaded once per store version, and every
+    response is kept with its etag and gzipped body until the versions of
+    its categories change, so repeat polls cost a version lookup.
+    """
+
+    def __init__(self, store=default_store):
+        self.store = store
+        self._categories = {}
+        self._responses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def records(self, category, version):
+        """The category's records, reloaded only when its version changed"""
+        cached = self._categories.get(category)
+        if cached and cached[0] == version:
+            return cached[1]
+        records = self.store.query(category=category)
+        entries = [(record, record_feature(record)) for record in records]
+        self._categories[category] = (version, entries)
+        return entries
+
+    def response(self, geojson, filters):
+        """(etag, body, gzipped body) for a request"""
+        categories, closing_from, closing_to, bbox, include_closed = filters
+        versions = self.store.versions()
+        today = date.today().isoformat()
+        key = (geojson, filters, today, tuple(versions.get(c, 0) for c in categories))
+
+        with self._lock:
+            if key in self._responses:
+                self._responses.move_to_end(key)
+                return self._responses[key]
+
+            matches = []
+            for category in categories:
+                for record, feature in self.records(category, versions.get(category, 0)):
+                    # records with an unknown closing date are always listed
+                    closing = record.closing
+                    if closing and not include_closed and closing < today:
+                        continue
+                    if closing_from and (not closing or closing < closing_from):
+                        continue
+                    if closing_to and (not closing or closing > closing_to):
+                        continue
+                    if bbox and not (
+                        feature and bbox[0] <= record.longitude <= bbox[2]
+                        and bbox[1] <= record.latitude <= bbox[3]
+                    ):
+                        continue
+                    matches.append((record, feature))
+
+            if geojson:
+                document = {
+                    "type": "FeatureCollection",
+                    "features": [feature for _, feature in matches if feature],
+                }
+            else:
+                document = [
+                    {**record_properties(record), "latitude": record.latitude, "longitude": record.longitude}
+                    for record, _ in matches
+                ]
+            body = json.dumps(document, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+            etag = hashlib.sha256(body).hexdigest()[:32]
+            compressed = gzip.compress(body, mtime=0) if len(body) >= GZIP_MIN_SIZE else None
+
+            self._responses[key] = (etag, body, compressed)
+            if len(self._responses) > RESPONSE_CACHE_SIZE:
+                self._responses.popitem(last=False)
+            return self._responses[key]
+
+
+class MapHandler(BaseHTTPRequestHandler):
+    """GET /items (json) and /items.geojson"""
+
+    def __init__(self, *args, map_data=None, **kwargs):
+        self.map_data = map_data
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path not in ("/items", "/items.json", "/items.geojson"):
+            self.send_error(404)
+            return
+        try:
+            filters = parse_filters(parse_qs(url.query))
+        except BadRequest as e:
+            self.send_error(400, str(e))
+            return
+
+        geojson = url.path.endswith(".geojson")
+        etag, body, compressed = self.map_data.response(geojson, filters)
+
+        # the gzipped body is a different representation, so it gets its own strong etag
+        use_gzip = compressed is not None and "gzip" in self.headers.get("Accept-Encoding", "")
+        etag = f'"{etag}-gz"' if use_gzip else f'"{etag}"'
+        if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            self._common_headers(etag, geojson)
+            self.end_headers()
+            return
+
+        payload = compressed if use_gzip else body
+        self.send_response(200)
+        self._common_headers(etag, geojson)
+        if use_gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _common_headers(self, etag, geojson):
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/geo+json" if geojson else "application/json")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Access-Control-Allow-Origin", "*")
+
+
+def serve(port=MAP_API_PORT, host=""):
+    server = ThreadingHTTPServer((host, port), partial(MapHandler, map_data=MapData()))
+    print(f"Serving map data on port {port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the map records over http")
+    parser.add_argument("--port", type=int, default=MAP_API_PORT)
+    parser.add_argument("--host", default="", help="address to listen on, all by default")
+    args = parser.parse_args()
+
+    serve(args.port, args.host)
@@ -0,0 +1,279 @@
+"""Pick the gemini model for each ai call by task, input length and each model's recent latency and errors"""
+
+import os
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import deque
+from scheduler import limit, parallel_map, RESOURCE_LIMITS
+
+QUALITY_MODEL = "gemini-2.5-flash"
+FAST_MODEL = "gemini-2.0-flash-lite"
+MAX_INPUT_CHARS = 2000
+# "gemini" or "stub" for offline runs and benchmarks
+AI_PROVIDER = os.environ.get("AI_PROVIDER", "gemini")
+
+# the fast model is good enough for these, inputs up to the length given
+FAST_TASKS = {"address": MAX_INPUT_CHARS, "summary": 1500}
+# a model slower than this at p95 (seconds), or failing more often, is avoided
+LATENCY_BUDGET = {"address": 5.0, "summary": 15.0}
+MAX_ERROR_RATE = 0.2
+# calls remembered per model, and calls needed before its stats are trusted
+WINDOW = 50
+MIN_SAMPLES = 5
+# older calls are forgotten, so an avoided model is tried again later
+STATS_SECONDS = 600
+
+
+class EmptyResponse(RuntimeError):
+    """The model answered without any text"""
+
+
+class ProviderUnavailable(RuntimeError):
+    """The ai provider could not be set up"""
+
+
+def is_quota_error(e):
+    return "429" in str(e) or "RESOURCE_EXHAUSTED" in str(e)
+
+
+class GeminiProvider:
+    """Calls the gemini api"""
+
+    def __init__(self):
+        from google import genai
+        from google.genai import types
+
+        self.types = types
+        # The client automatically picks up the GEMINI_API_KEY environment variable.
+        try:
+            self.client = genai.Client()
+        except Exception as e:
+            raise ProviderUnavailable(
+                f"Error initializing Gemini client: {e}. "
+                "Please ensure you have set the GEMINI_API_KEY environment variable."
+            ) from e
+
+    def generate(self, model, system_instruction, text):
+        response = self.client.models.generate_content(
+            model=model,
+            contents=[text],
+            config=self.types.GenerateContentConfig(
+                system_instruction=system_instruction,
+            ),
+        )
+        if response is None:
+            raise RuntimeError("Empty response from model")
+
+        if not getattr(response, "text", None):
+            finish_reason = None
+            safety = None
+            if getattr(response, "candidates", None):
+                candidate = response.candidates[0]
+                finish_reason = getattr(candidate, "finish_reason", None)
+                safety = getattr(candidate, "safety_ratings", None)
+            raise EmptyResponse(f"No text returned. finish_reason={finish_reason} safety={safety}")
+
+        return response.text.strip()
+
+
+class StubProvider:
+    """
+    Deterministic offline stand-in for the gemini api.
+
+    Each model answers with the first sentence of the text after a latency
+    that grows with the input, and fails the calls whose hash falls under
+    its error rate, so the same inputs always give the same run.
+    """
+
+    def __init__(self, models=None, time_scale=1.0):
+        # model: (base seconds, seconds per 1000 chars, error rate)
+        self.models = models or {
+            QUALITY_MODEL: (0.8, 1.2, 0.02),
+            FAST_MODEL: (0.3, 0.4, 0.05),
+        }
+        self.time_scale = time_scale
+
+    def generate(self, model, system_instruction, text):
+        base, per_thousand, error_rate = self.models[model]
+        time.sleep((base + per_thousand * len(text) / 1000) * self.time_scale)
+        digest = hashlib.blake2b(f"{model}:{text}".encode("utf-8"), digest_size=8).digest()
+        if int.from_bytes(digest, "big") / 2 ** 64 < error_rate:
+            raise RuntimeError("429 RESOURCE_EXHAUSTED (stub)")
+        return text.split(". ")[0].strip()
+
+
+class ModelStats:
+    """Latency and outcome of a model's last WINDOW calls, within STATS_SECONDS"""
+
+    def __init__(self):
+        self.calls = deque(maxlen=WINDOW)
+
+    def add(self, seconds, ok):
+        self.calls.append((time.monotonic(), seconds, ok))
+
+    def recent(self):
+        while self.calls and self.calls[0][0] < time.monotonic() - STATS_SECONDS:
+            self.calls.popleft()
+        return self.calls
+
+    def p95(self):
+        latencies = sorted(seconds for _, seconds, _ in self.recent())
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def error_rate(self):
+        calls = self.recent()
+        if not calls:
+            return 0.0
+        return sum(1 for _, _, ok in calls if not ok) / len(calls)
+
+    def healthy(self, budget):
+        if len(self.recent()) < MIN_SAMPLES:
+            return True
+        return self.p95() <= budget and self.error_rate() <= MAX_ERROR_RATE
+
+
+class ModelRouter:
+    """
+    Chooses the model for each call and falls back to the other on quota errors.
+
+    Short inputs and address extraction go to the fast model, the rest to
+    the quality model. A model whose rolling p95 latency is over the task's
+    budget, or whose error rate is too high, is only used when the other
+    one is doing worse.
+    """
+
+    def __init__(self, provider=None, models=(QUALITY_MODEL, FAST_MODEL), budgets=LATENCY_BUDGET):
+        self._provider = provider
+        self.models = models
+        self.budgets = budgets
+        self.stats = {model: ModelStats() for model in models}
+        self.chosen = {model: 0 for model in models}
+        self._lock = threading.Lock()
+
+    @property
+    def provider(self):
+        # created on first use, so importing the ai modules needs no api key
+        with self._lock:
+            if self._provider is None:
+                self._provider = StubProvider() if AI_PROVIDER == "stub" else GeminiProvider()
+            return self._provider
+
+    def candidates(self, task, text):
+        """Models to try for a call, best first"""
+        fast = len(text) <= FAST_TASKS.get(task, 0)
+        preferred = [FAST_MODEL, QUALITY_MODEL] if fast else [QUALITY_MODEL, FAST_MODEL]
+        preferred = [model for model in preferred if model in self.models]
+
+        budget = self.budgets.get(task, max(self.budgets.values()))
+        with self._lock:
+            healthy = [model for model in preferred if self.stats[model].healthy(budget)]
+            if healthy:
+                return healthy + [model for model in preferred if model not in healthy]
+            # all of them are struggling, start with the one failing least
+            return sorted(preferred, key=lambda m: (self.stats[m].error_rate(), self.stats[m].p95()))
+
+    def _call(self, model, system_instruction, text, retries):
+        for attempt in range(retries):
+            try:
+                with limit("gemini"):
+                    start = time.monotonic()
+                    try:
+                        result = self.provider.generate(model, system_instruction, text)
+                    except EmptyResponse:
+                        # the model answered, it just had nothing to say
+                        self._record(model, time.monotonic() - start, True)
+                        raise
+                    except Exception:
+                        self._record(model, time.monotonic() - start, False)
+                        raise
+                    self._record(model, time.monotonic() - start, True)
+                    return result
+            except Exception as e:
+                if is_quota_error(e) and attempt < retries - 1:
+                    wait = (2 ** attempt) + random.uniform(0, 1)
+                    print(f"Rate limited on {model}, retrying in {wait:.1f}s (attempt {attempt + 1}/{retries})...")
+                    time.sleep(wait)
+                else:
+                    raise
+
+    def _record(self, model, seconds, ok):
+        with self._lock:
+            self.stats[model].add(seconds, ok)
+
+    def generate(self, task, system_instruction, text, retries=4):
+        """
+        Run the task on the best model for it, trying the next one when a
+        model is out of quota. Other errors are raised straight away.
+        """
+        text = text[:MAX_INPUT_CHARS]
+        models = self.candidates(task, text)
+        for i, model in enumerate(models):
+            with self._lock:
+                self.chosen[model] += 1
+            try:
+                return self._call(model, system_instruction, text, retries)
+            except Exception as e:
+                if is_quota_error(e) and i < len(models) - 1:
+                    print(f"Quota exceeded on {model}, retrying with {models[i + 1]}...")
+                    continue
+                raise
+
+    def report(self):
+        """Print the calls, p95 latency and error rate of each model"""
+        with self._lock:
+            if not any(self.chosen.values()):
+                return
+            for model in self.models:
+                stats = self.stats[model]
+                print(
+                    f"{model:<24} {self.chosen[model]:>5} calls  p95 {stats.p95():.2f}s  "
+                    f"errors {stats.error_rate():.0%}"
+                )
+
+
+# shared by the summary and address modules
+router = ModelRouter()
+
+
+def bench(count, time_scale, workers=None):
+    """Route a synthetic batch of address and summary calls through the stub provider"""
+    # the budgets shrink with the simulated latencies
+    budgets = {task: budget * time_scale for task, budget in LATENCY_BUDGET.items()}
+    test_router = ModelRouter(StubProvider(time_scale=time_scale), budgets=budgets)
+    sentence = "Application is made for the departure from the building lines for a double storey dwelling. "
+    calls = [
+        ("address" if i % 3 == 0 else "summary", f"Erf {i}. " + sentence * (1 + i * 7 % 24))
+        for i in range(count)
+    ]
+
+    def run(call):
+        task, text = call
+        try:
+            test_router.generate(task, "", text, retries=1)
+            return True
+        except Exception:
+            return False
+
+    start = time.monotonic()
+    results = parallel_map(run, calls, workers=workers or RESOURCE_LIMITS["gemini"])
+    elapsed = time.monotonic() - start
+    print(f"{count} calls in {elapsed:.2f}s, {results.count(False)} failed")
+    test_router.report()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the model routing offline with the stub provider")
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument(
+        "--time-scale", type=float, default=0.01,
+        help="fraction of the stub's simulated latency actually slept",
+    )
+    parser.add_argument("--workers", type=int, default=None, help="calls made at once")
+    args = parser.parse_args()
+
+    bench(args.calls, args.time_scale, args.workers)
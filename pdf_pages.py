@@ -0,0 +1,85 @@
+"""Stream pdf pages one at a time with bounded memory"""
+
+import os
+import resource
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdftypes import resolve1
+from pdfplumber.page import Page
+
+# pages scanned per extracted field
+MAX_PAGES = 10
+# memory a single document may add to the process before it is abandoned
+MEMORY_LIMIT_MB = int(os.environ.get("PDF_MEMORY_LIMIT_MB", 1024))
+
+
+class MemoryLimitExceeded(Exception):
+    pass
+
+
+def current_rss_mb():
+    """Resident memory of this process in MB"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        # no procfs, fall back to the peak (KB on linux, bytes on macos)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if peak > 1 << 30 else peak / 1024
+
+
+def release_page(page):
+    """Drop the layout objects pdfplumber caches on a page"""
+    close = getattr(page, "close", None) or getattr(page, "flush_cache", None)
+    if close:
+        close()
+
+
+class PdfPages:
+    """
+    Pages of an open pdfplumber document, loaded one at a time.
+
+    Pages are read from the pdfminer page tree as they are reached instead
+    of through pdf.pages, which builds every Page up front.
+
+    Each page's cached objects are released as soon as the caller moves on
+    to the next page, so memory stays flat however long the document is.
+    The memory used since the document was opened is checked before each
+    page and MemoryLimitExceeded is raised when it goes over the limit.
+    """
+
+    def __init__(self, pdf, memory_limit_mb=MEMORY_LIMIT_MB):
+        self.pdf = pdf
+        self.memory_limit_mb = memory_limit_mb
+        self.baseline_mb = current_rss_mb()
+        self._count = None
+
+    def __len__(self):
+        """Page count from the page tree root, without loading the pages"""
+        if self._count is None:
+            try:
+                self._count = int(resolve1(resolve1(self.pdf.doc.catalog["Pages"])["Count"]))
+            except (KeyError, TypeError, ValueError):
+                self._count = sum(1 for _ in PDFPage.create_pages(self.pdf.doc))
+        return self._count
+
+    def iter(self, max_pages=MAX_PAGES):
+        """Yield up to max_pages pages from the start of the document"""
+        doctop = 0
+        for i, page_obj in enumerate(PDFPage.create_pages(self.pdf.doc)):
+            if max_pages is not None and i >= max_pages:
+                break
+            self.check_memory()
+            page = Page(self.pdf, page_obj, page_number=i + 1, initial_doctop=doctop)
+            doctop += page.height
+            try:
+                yield page
+            finally:
+                release_page(page)
+
+    def check_memory(self):
+        used = current_rss_mb() - self.baseline_mb
+        if used > self.memory_limit_mb:
+            raise MemoryLimitExceeded(
+                f"document used {used:.0f}MB, over the {self.memory_limit_mb}MB limit"
+            )
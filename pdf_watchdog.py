@@ -0,0 +1,144 @@
+"""Parse pdfs in a supervised subprocess and quarantine files that hang or crash the parser"""
+
+import os
+import json
+import hashlib
+import threading
+import multiprocessing
+from datetime import datetime
+
+# wall-clock seconds a single pdf may take to parse
+PARSE_TIMEOUT = int(os.environ.get("PDF_PARSE_TIMEOUT", 120))
+QUARANTINE_FILE = "quarantine.json"
+_quarantine_lock = threading.Lock()
+
+# forkserver children start from a clean single threaded process, so locks
+# held by the pipeline's worker threads can't deadlock the parse
+if "forkserver" in multiprocessing.get_all_start_methods():
+    _context = multiprocessing.get_context("forkserver")
+    _context.set_forkserver_preload(["process_documents"])
+else:
+    _context = multiprocessing.get_context("spawn")
+
+
+class ParseTimeout(Exception):
+    pass
+
+
+class ParseCrashed(Exception):
+    pass
+
+
+def file_hash(path):
+    """sha256 of the file contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_quarantine():
+    """Load the quarantined files, keyed by content hash"""
+    try:
+        if os.path.exists(QUARANTINE_FILE):
+            with open(QUARANTINE_FILE, "r") as f:
+                return json.load(f)
+    except:
+        pass
+    return {}
+
+
+def save_quarantine(quarantine):
+    """Save the quarantined files"""
+    with open(QUARANTINE_FILE, "w") as f:
+        json.dump(quarantine, f, indent=2)
+
+
+def quarantine_file(path, digest, reason):
+    """Add a file to the quarantine so later runs skip it until its contents change"""
+    with _quarantine_lock:
+        quarantine = load_quarantine()
+        quarantine[digest] = {
+            "path": str(path),
+            "reason": reason,
+            "date": datetime.now().isoformat(timespec="seconds"),
+        }
+        save_quarantine(quarantine)
+    print(f"\n{path}: QUARANTINED - {reason}")
+
+
+def quarantine_report():
+    """Print the quarantined files"""
+    quarantine = load_quarantine()
+    if not quarantine:
+        print("No quarantined files")
+        return
+    print(f"{len(quarantine)} quarantined files:")
+    for digest, entry in sorted(quarantine.items(), key=lambda e: e[1]["date"]):
+        print(f"    {entry['date']}  {entry['path']}  ({entry['reason']})  {digest[:12]}")
+
+
+def _run_child(conn, func, args):
+    try:
+        conn.send(("ok", func(*args)))
+    except BaseException as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def run_with_deadline(func, args, timeout=PARSE_TIMEOUT):
+    """
+    Run func(*args) in a subprocess and return its result.
+
+    Raises ParseTimeout when it takes longer than timeout seconds (the
+    process is killed) and ParseCrashed when it raises or dies.
+    """
+    parent_conn, child_conn = _context.Pipe(duplex=False)
+    process = _context.Process(target=_run_child, args=(child_conn, func, args), daemon=True)
+    process.start()
+    child_conn.close()
+
+    try:
+        if not parent_conn.poll(timeout):
+            process.kill()
+            process.join()
+            raise ParseTimeout(f"no result after {timeout}s")
+        try:
+            status, value = parent_conn.recv()
+        except EOFError:
+            status, value = None, None
+    finally:
+        parent_conn.close()
+
+    process.join(10)
+    if status is None:
+        raise ParseCrashed(f"parser exited with code {process.exitcode}")
+    if status == "error":
+        raise ParseCrashed(value)
+    return value
+
+
+def parse_pdf(path, func, timeout=PARSE_TIMEOUT):
+    """
+    Parse a pdf with func(path) under the watchdog.
+
+    Returns None without parsing when the file is quarantined, and
+    quarantines the file when the parse times out or crashes.
+    """
+    digest = file_hash(path)
+    entry = load_quarantine().get(digest)
+    if entry:
+        print(f"\n{path}: SKIPPED - quarantined {entry['date']} ({entry['reason']})")
+        return None
+
+    try:
+        return run_with_deadline(func, (path,), timeout)
+    except (ParseTimeout, ParseCrashed) as e:
+        quarantine_file(path, digest, str(e))
+        return None
+
+
+if __name__ == "__main__":
+    quarantine_report()
@@ -3,13 +3,22 @@ import re
 import os
 import json
 from pathlib import Path
-from upload_gdrive import upload_files
+from upload_queue import enqueue
 from collections import defaultdict
-from ai_summarise_descriptions import ai_summarise_text
+from local_summary import summarise
 from ai_extract_address import ai_extract_address
 from datetime import datetime, timedelta
-import signal
-import shutil
+from scheduler import limit, parallel_map
+from address_normalizer import normalise_address as format_address
+from download_emails import is_notice_file, load_cache as load_subjects
+from pdf_pages import PdfPages, MemoryLimitExceeded
+from pdf_watchdog import parse_pdf
+from retention import record_closing_date, expire
+from fingerprints import index as fingerprints
+from erf_index import erf_address
+
+# days after the closing date a notice stays on the map
+EXPIRY_GRACE_DAYS = int(os.environ.get("EXPIRY_GRACE_DAYS", 10))
 
 # Regex patterns
 address_pattern = re.compile(
@@ -22,95 +31,187 @@ close_date_pattern = re.compile(
     r"Closing date for objections, comments or representations\s*\n([\d\w\s]+)", re.IGNORECASE
 )
 
-class TimeoutException(Exception):
-    pass
-
-def timeout_handler(signum, frame):
-    raise TimeoutException()
-
-def process_documents(path):
-    """ Open the public participation notice and extract the data """
+def process_documents(path, subject=None):
+    """
+    Open the public participation notice and extract the data.
+    subject is the email's subject line, looked up in the subject cache when not given.
+    """
     documents_path = Path(path)
     document_data = []
 
-    pdf_files = documents_path.glob("*.pdf")
-    if next(pdf_files, None) is None:
+    pdf_files = sorted(documents_path.glob("*.pdf"))
+    if not pdf_files:
         print(f"{path}: WARNING NO PDF ATTACHEMENTS")
         return document_data
 
+    # the same notice sent again under another email id
+    original = fingerprints.add_files(documents_path, is_notice_file)
+    if original:
+        print(f"\n{path}: SKIPPED - duplicate of {original}")
+        return document_data
+    if subject is None:
+        subject = load_subjects().get(documents_path.name, "")
+
     for pdf_file in pdf_files:
         # only match the Notice or Advertising Notice pdfs
-        file_name = pdf_file.name.lower()
-        if not (file_name.startswith("notice") or "advertising" in file_name or "public" in file_name):
+        if not is_notice_file(pdf_file.name):
             continue
-        with pdfplumber.open(pdf_file) as pdf:
-            pages = pdf.pages
-            if pages:
-                # extract closing date
-                closing_date = extract_closing_date(pages)
-                if not closing_date:
-                    print(f"\n{pdf_file.name}: WARNING NO DATE")
-                    continue
-                elif expired_date(closing_date):
-                    # check if closing date far in the past
-                    print(f"\n{pdf_file.name}: DELETING - closing date {closing_date} expired")
-                    shutil.rmtree(documents_path)
-                    return []
-
-                # Extract address
-                address = extract_address(pages)
-                if not address:
-                    print(f"\n{pdf_file.name}: WARNING NO ADDRESS")
-                    address = ai_extract_address(pdf_file.name, path)
-                    address = format_address(address)
-                # title is just street location
-                title = address.split(",")[0].strip()
-                # extract description
-                description = extract_description(pages, path)
-
-                # upload all the attachments from the email to the google drive
-                file_link = upload_files(path, pdf_file, address)
-
-                document_data.append({
-                    "filename": pdf_file.name,
-                    "address": address,
-                    "title": title,
-                    "description": description,
-                    "closing_date": closing_date,
-                    "file_link": file_link
-                })
-                print(f"\n{path}{pdf_file.name}:")
-                print(f"    Title:       {title}")
-                print(f"    Description: {description}")
-                break
+
+        # parse in a watchdog subprocess so a corrupt pdf can't hang the run
+        with limit("cpu"):
+            parsed = parse_pdf(pdf_file, parse_notice_pdf)
+        if not parsed:
+            continue
+
+        # extract closing date
+        closing_date = parsed["closing_date"]
+        if not closing_date:
+            print(f"\n{pdf_file.name}: WARNING NO DATE")
+            continue
+        try:
+            closing = parse_date(closing_date)
+        except ValueError:
+            closing = None
+        if parsed["expired"]:
+            # check if closing date far in the past
+            print(f"\n{pdf_file.name}: DELETING - closing date {closing_date} expired")
+            expire(documents_path, closing)
+            return []
+        if closing:
+            # so retention can prune the folder later without parsing it again
+            record_closing_date(documents_path, closing)
+
+        # a resent notice with different files but the same text
+        original = fingerprints.add_text(documents_path, parsed["description"])
+        if original:
+            print(f"\n{pdf_file.name}: SKIPPED - duplicate of {original}")
+            return []
+
+        # Extract address
+        # an erf number in the subject or pdf is looked up locally, with its centroid
+        address = erf_address(parsed["address"], subject, parsed["erf_text"])
+        if not address:
+            print(f"\n{pdf_file.name}: WARNING NO ADDRESS")
+            address = ai_extract_address(pdf_file.name, path)
+            address = format_address(address)
+        # title is just street location
+        title = address.split(",")[0].strip()
+        # extract description
+        description = parsed["description"]
+        if description:
+            # local summary, ai for the long ones
+            description = summarise(description, path)
+
+        # queue the upload of all the attachments from the email to the google drive
+        file_link = enqueue(path, pdf_file, address)
+
+        document_data.append({
+            "email_id": documents_path.name,
+            "filename": pdf_file.name,
+            "address": address,
+            "title": title,
+            "description": description,
+            "closing_date": closing_date,
+            "file_link": file_link
+        })
+        print(f"\n{path}{pdf_file.name}:")
+        print(f"    Title:       {title}")
+        print(f"    Description: {description}")
+        break
 
     return document_data
 
 
-def expired_date(date_str: str, days=10) -> bool:
-    """ Check if the string date is more than 10 days in the past """
+def parse_notice_pdf(pdf_file):
+    """
+    Extract the closing date, address and description text from a notice pdf.
+    Runs in the watchdog subprocess, so it makes no ai or drive calls.
+    """
+    with pdfplumber.open(pdf_file) as pdf:
+        pages = PdfPages(pdf)
+        if not pages:
+            return None
+
+        parsed = {"closing_date": None, "expired": False, "address": "", "description": "", "erf_text": ""}
+        # a document too big to find the date in is quarantined
+        parsed["closing_date"] = extract_closing_date(pages)
+        if not parsed["closing_date"]:
+            return parsed
+        try:
+            parsed["expired"] = expired_date(parsed["closing_date"])
+        except ValueError as e:
+            print(f"\n{pdf_file.name}: WARNING - {e}")
+        if parsed["expired"]:
+            return parsed
+
+        try:
+            parsed["address"] = extract_address(pages)
+        except MemoryLimitExceeded as e:
+            print(f"\n{pdf_file.name}: WARNING - {e}")
+        try:
+            parsed["erf_text"] = extract_erf_text(pages)
+        except MemoryLimitExceeded as e:
+            print(f"\n{pdf_file.name}: WARNING - {e}")
+        try:
+            parsed["description"] = extract_description_text(pages, str(pdf_file))
+        except MemoryLimitExceeded as e:
+            print(f"\n{pdf_file.name}: WARNING - {e}")
+        return parsed
+
+
+def expired_date(date_str: str, days=None) -> bool:
+    """ Check if the string date is more than the grace period in the past """
+    return is_expired(parse_date(date_str), days)
+
+
+def parse_date(date_str: str):
+    """ Parse a closing date like '12 Mar 2026' or '12 March 2026' """
     formats = ["%d %b %Y", "%d %B %Y"]
-    
+
     for fmt in formats:
         try:
-            date = datetime.strptime(date_str, fmt)
-            break
+            return datetime.strptime(date_str, fmt).date()
         except ValueError:
             continue
-    else:
-        raise ValueError(f"Invalid date format: {date_str}")
+    raise ValueError(f"Invalid date format: {date_str}")
+
 
-    return datetime.now() - date > timedelta(days=days)
+def is_expired(closing_date, days=None) -> bool:
+    """ Check if the date is more than the grace period (10 days by default) in the past """
+    if days is None:
+        days = EXPIRY_GRACE_DAYS
+    return datetime.now() - datetime.combine(closing_date, datetime.min.time()) > timedelta(days=days)
 
 
-def extract_address(pages, attempt=0):
+# pages scanned for each field
+ADDRESS_PAGES = 2
+DESCRIPTION_PAGES = 6
+CLOSING_DATE_PAGES = 10
+
+
+def extract_address(pages):
     """ 
     Get the address from  the pdf page
     Usually in the format 'Description and physical address'
     """
     # check first page and second page
-    first_page = pages[attempt]
-    words = first_page.extract_words()
+    for page in pages.iter(ADDRESS_PAGES):
+        address = extract_page_address(page)
+        if address is not None:
+            return format_address(address)
+    return ""
+
+def extract_erf_text(pages):
+    """ The lines of the address pages that mention an erf, with the suburb usually on them """
+    lines = []
+    for page in pages.iter(ADDRESS_PAGES):
+        text = page.extract_text() or ""
+        lines.extend(line for line in text.splitlines() if "erf" in line.lower())
+    return "\n".join(lines)
+
+def extract_page_address(page):
+    """ Get the address below the label on a page, or None if the page has no label """
+    words = page.extract_words()
 
     # Group words by top coordinate (lines)
     lines = defaultdict(list)
@@ -128,12 +229,8 @@ def extract_address(pages, attempt=0):
             label_top = top
             break
 
-    # try the second page
     if label_top is None: 
-        if len(pages) < (attempt + 1):
-            return extract_address(pages, attempt + 1)
-        else:
-            return ""
+        return None
 
     # Find the next non-empty line(s) below the label
     address_lines = []
@@ -146,59 +243,30 @@ def extract_address(pages, attempt=0):
                 if any(c.isdigit() for c in line_text):
                     break
 
-    address =  " ".join(address_lines) if address_lines else ""
-    return format_address(address)
-
-def format_address(address):
-    if not address:
-        address = ""
-    address = re.sub(r"\(.*?\)", "", address).strip()
-
-    # patch weird formats
-    def _patch_addresss(raw_address):
-        new_address = re.sub(r'\b(?:AND|&)\b', ',', raw_address, flags=re.IGNORECASE)
-        new_address = re.sub(r'\s*\([^)]*\)', '', raw_address)
-        new_address = re.sub(r'\s*,\s*', ', ', new_address)
-        new_address = re.sub(r'\s+', ' ', new_address).strip()
-        match = re.match(r'(\d+)', new_address)
-        if match:
-            number = match.group(1)
-            # Remove numbers before the street that are not part of a range
-            new_address = re.sub(r'^[\d,\s]+', number + ' ', new_address)
-
-        parts = new_address.split(', ')
-        parts = [camel_case_word(part) for part in parts]
-        # add cape town if missing
-        if parts[len(parts)-1] != "Cape Town":
-            parts.append("Cape Town")
-        new_address = ', '.join(parts)
+    return " ".join(address_lines) if address_lines else ""
 
-        return new_address
+def extract_description(pages, description_id):
+    """ Extract the application description and summarise it """
+    description = extract_description_text(pages, description_id)
+    if description:
+        # local summary, ai for the long ones
+        description = summarise(description, description_id)
 
-    return _patch_addresss(address)
+    return description
 
-def extract_description(pages, description_id):
+def extract_description_text(pages, description_id):
     # Extract description
     # Find top coordinate of "Purpose of the application" up until "Enquiries"
     raw_text = ""
     capture = False
 
     # multi page descriptions
-    for i, page in enumerate(pages):
-        # dont go through too many pages
-        if i >= 6:
-            break
+    # dont go through too many pages
+    for page in pages.iter(DESCRIPTION_PAGES):
         words = []
         try:
-            # Set a 30-second timeout for pdfplumber corrupted pages
-            signal.signal(signal.SIGALRM, timeout_handler)
-            signal.alarm(30)
-            
             words = page.extract_words()
-            # Cancel the alarm
-            signal.alarm(0)
-            
-        except (TimeoutException, Exception) as e:
+        except Exception as e:
             print(f"Error processing {description_id}: {e}")
             continue
             
@@ -259,10 +327,6 @@ def extract_description(pages, description_id):
     description = description.replace("..", ".")
     description = description.replace("..", ".")
 
-    if description:
-        # ai summary
-        description = ai_summarise_text(description, description_id)
-
     return description
 
 def extract_closing_date(pages):
@@ -275,7 +339,7 @@ def extract_closing_date(pages):
         re.IGNORECASE
     )
 
-    for page in pages:
+    for page in pages.iter(CLOSING_DATE_PAGES):
         words = page.extract_words()
 
         # Find the top coordinate of "Closing date"
@@ -312,7 +376,7 @@ def extract_closing_date(pages):
                 return camel_case_word(line_text)
 
     # Fallback: scan full page text for "on or before <date>" (memo-style documents)
-    for page in pages:
+    for page in pages.iter(CLOSING_DATE_PAGES):
         text = page.extract_text() or ""
         match = on_or_before_pattern.search(text)
         if match:
@@ -326,12 +390,19 @@ def camel_case_word(words):
 def process_all_attachments(directory):
     """ loop through the emails in the directory and extract the information from the files """
 
+    # sorted so the exported rows keep the same order between runs
+    paths = [
+        os.path.join(directory, email_id)
+        for email_id in sorted(os.listdir(directory))
+        if os.path.isdir(os.path.join(directory, email_id))
+    ]
+
+    # the subject cache is read once for the whole directory
+    subjects = load_subjects()
     data = []
-    for email_id in os.listdir(directory):
-        full_path = os.path.join(directory, email_id)
-        if os.path.isdir(full_path):
-            result = process_documents(full_path)
-            data.extend(result)
+    documents = lambda path: process_documents(path, subjects.get(os.path.basename(path), ""))
+    for result in parallel_map(documents, paths):
+        data.extend(result)
 
     print(f"Got {len(data)} {directory} items")
     return data
\ No newline at end of file
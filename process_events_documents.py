@@ -3,11 +3,15 @@
 import re
 import os
 import json
-import shutil
 import unicodedata
+from datetime import date, timedelta
+from functools import lru_cache
 from download_emails import CACHE_FILE
-from process_documents import format_address, expired_date
-from upload_gdrive import upload_files
+from process_documents import is_expired
+from address_normalizer import normalise_address as format_address
+from upload_queue import enqueue
+from scheduler import parallel_map
+from retention import record_closing_date, expire
 
 # Well-known Cape Town venues → canonical address
 VENUE_LOOKUP = {
@@ -32,15 +36,35 @@ VENUE_LOOKUP = {
     "mount nelson hotel": "76 Orange Street, Gardens, Cape Town",
 }
 
-# Matches the start of a date expression, e.g. "13-15 April 2026", "5th January 2026"
-_DATE_RE = re.compile(
-    r"\b\d{1,2}(?:st|nd|rd|th)?(?:\s*[-–—]\s*\d{1,2}(?:st|nd|rd|th)?)?\s+"
-    r"(?:January|February|March|April|May|June|July|August|September|October|November|December)"
-    r"(?:\s+\d{4})?",
+_MONTHS = (
+    "January", "February", "March", "April", "May", "June", "July",
+    "August", "September", "October", "November", "December",
+)
+_MONTH_NUMBERS = {month.lower(): i for i, month in enumerate(_MONTHS, start=1)}
+_DAY = r"\d{1,2}(?:st|nd|rd|th)?"
+
+# Leading event code, e.g. "EO26-0155 - " or "EP26-0066 | "
+_CODE_RE = re.compile(r"(E[A-Z]?\d+-\d+)\s*[-|]\s*")
+
+# Tokens that split a subject into segments, scanned once left to right:
+#   date       "13-15 April 2026", "9 - 10 February", "5th January 2026"
+#   qualifier  trailing "(External Services)", "(Externa Services)", "( Extern"...
+#   sep        " - " or "|" between fields
+_TOKEN_RE = re.compile(
+    rf"(?P<date>\b(?P<start>{_DAY})(?:\s*[-–—]\s*(?P<end>{_DAY}))?\s+"
+    rf"(?P<month>{'|'.join(_MONTHS)})(?:\s+(?P<year>\d{{4}}))?)"
+    r"|(?P<qualifier>\s*\(\s*extern[^)]*\)\s*$)"
+    r"|(?P<sep>\s+-\s+|\s*\|\s*)",
     re.IGNORECASE,
 )
+_SPACED_HYPHEN_RE = re.compile(r"\s+-\s+")
+_ORDINAL_RE = re.compile(r"(?:st|nd|rd|th)$", re.IGNORECASE)
+
+# Bare area names that are a city suffix rather than the venue itself
+_GENERIC = {"cape town", "cbd", "foreshore", "green point", "waterfront"}
 
 
+@lru_cache(maxsize=1024)
 def _normalise(text: str) -> str:
     """Lowercase, strip accents, collapse non-alphanumeric runs to a single space."""
     text = unicodedata.normalize("NFD", text)
@@ -54,6 +78,7 @@ def _normalise(text: str) -> str:
 _NORMALISED_LOOKUP = {_normalise(k): v for k, v in VENUE_LOOKUP.items()}
 
 
+@lru_cache(maxsize=1024)
 def _resolve_address(venue_text: str) -> str:
     """Return a geocodeable address for a venue string.
 
@@ -69,58 +94,85 @@ def _resolve_address(venue_text: str) -> str:
     return format_address(venue_text)
 
 
-def parse_event_subject(subject: str) -> dict | None:
-    """Parse a Cape Town event permit subject line into structured fields.
+def _event_day(day: str, month: str, year: str | None, today: date) -> date | None:
+    """Build the date for a day of an event, inferring a missing year from today.
 
-    Expected (approximate) format:
-        EO##-#### - [Title] - [Venue/Address] - [Date range] (External Services)
-
-    Returns a dict with keys: title, venue, address, event_date
-    or None when the subject cannot be parsed reliably.
+    Subjects without a year are assumed to be within the next few months, so a
+    date more than half a year in the past rolls over to next year.
     """
-    # Strip trailing qualifiers: (External Services), (External), (Externa Services), etc.
-    # Allow a space inside the paren and accept truncated spellings like "Extern".
-    clean = re.sub(r"\s*\(\s*[Ee]xtern[^)]*\)\s*$", "", subject).strip()
-    # Normalise pipe separators used in some free-concert subjects
-    clean = re.sub(r"\s*\|\s*", " - ", clean)
-
-    # Collapse date ranges that use " - " between the two day numbers so they
-    # don't get mistaken for field separators, e.g. "9 - 10 February" → "9-10 February"
-    _MONTHS = (r"January|February|March|April|May|June|July|August|"
-               r"September|October|November|December")
-    clean = re.sub(
-        rf"(\b\d{{1,2}}(?:st|nd|rd|th)?)\s+-\s+(\d{{1,2}}(?:st|nd|rd|th)?\s+(?:{_MONTHS}))",
-        r"\1-\2",
-        clean,
-        flags=re.IGNORECASE,
-    )
-
-    # Extract and remove the leading event code (e.g. "EO26-0155", "EP26-0066")
-    code_match = re.match(r"^(E[A-Z]?\d+-\d+)\s*-\s*", clean)
-    if code_match:
-        remainder = clean[code_match.end():].strip()
-    else:
-        # Fallback: event code embedded in title, e.g. "Hollywoodbets ... (EO25-0750) - date"
-        remainder = clean
+    day_number = int(_ORDINAL_RE.sub("", day))
+    month_number = _MONTH_NUMBERS[month.lower()]
+    try:
+        if year:
+            return date(int(year), month_number, day_number)
+        event_day = date(today.year, month_number, day_number)
+        if today - event_day > timedelta(days=183):
+            event_day = date(today.year + 1, month_number, day_number)
+        return event_day
+    except ValueError:
+        return None
 
-    # Split remainder on " - "
-    parts = re.split(r"\s+-\s+", remainder)
+
+def _split_segments(text: str) -> list[list]:
+    """Split a subject into [text, first date match] segments in a single pass."""
+    segments = [["", None]]
+    pos = 0
+    for match in _TOKEN_RE.finditer(text):
+        segment = segments[-1]
+        segment[0] += text[pos:match.start()]
+        pos = match.end()
+
+        if match.group("qualifier") is not None:
+            break
+        if match.group("sep") is not None:
+            segments.append(["", None])
+            continue
+
+        # collapse "9 - 10 February" to "9-10 February" so it reads as one range
+        segment[0] += _SPACED_HYPHEN_RE.sub("-", match.group("date"))
+        if segment[1] is None:
+            segment[1] = match
+    else:
+        segments[-1][0] += text[pos:]
 
     # Merge any segment that starts with "(" back into the previous one — these
     # are parenthetical clarifications that belong to the preceding venue name,
     # e.g. "DSK - (German School), 28 Bay View Ave" should stay together.
-    merged: list[str] = []
-    for part in parts:
-        if merged and part.lstrip().startswith("("):
-            merged[-1] = merged[-1] + " - " + part
+    merged: list[list] = []
+    for segment in segments:
+        if merged and segment[0].lstrip().startswith("("):
+            merged[-1][0] += " - " + segment[0]
+            merged[-1][1] = merged[-1][1] or segment[1]
         else:
-            merged.append(part)
-    parts = merged
+            merged.append(segment)
+    return merged
+
+
+def parse_event_subject(subject: str, today: date | None = None) -> dict | None:
+    """Parse a Cape Town event permit subject line into structured fields.
+
+    Expected (approximate) format:
+        EO##-#### - [Title] - [Venue/Address] - [Date range] (External Services)
+
+    Returns a dict with keys: title, venue, address, event_date, start_date,
+    end_date (the dates as datetime.date, or None when they are not valid)
+    or None when the subject cannot be parsed reliably.
+    """
+    if today is None:
+        today = date.today()
+
+    clean = subject.strip()
+    # Skip the leading event code (e.g. "EO26-0155", "EP26-0066"). When it is
+    # embedded in the title instead, e.g. "Hollywoodbets ... (EO25-0750) - date",
+    # the whole subject is parsed.
+    code_match = _CODE_RE.match(clean)
+    segments = _split_segments(clean[code_match.end():] if code_match else clean)
+    parts = [text.strip() for text, _ in segments]
 
     # Find the rightmost segment that looks like a date
     date_idx = None
-    for i in range(len(parts) - 1, -1, -1):
-        if _DATE_RE.search(parts[i]):
+    for i in range(len(segments) - 1, -1, -1):
+        if segments[i][1] is not None:
             date_idx = i
             break
 
@@ -132,7 +184,6 @@ def parse_event_subject(subject: str) -> dict | None:
 
     # If the venue segment is a bare city/area name (no comma, no street number),
     # it's probably a trailing city suffix — merge it with the preceding segment.
-    _GENERIC = {"cape town", "cbd", "foreshore", "green point", "waterfront"}
     if _normalise(venue_text) in _GENERIC and date_idx >= 2:
         venue_text = parts[date_idx - 2] + ", " + venue_text
         title_parts = parts[:date_idx - 2]
@@ -141,28 +192,33 @@ def parse_event_subject(subject: str) -> dict | None:
 
     title = " - ".join(title_parts).strip() if title_parts else venue_text
 
-    # Extract the first date occurrence from the date segment
-    date_match = _DATE_RE.search(parts[date_idx])
-    event_date = date_match.group().strip() if date_match else parts[date_idx].strip()
-    # Capitalise month name
-    event_date = re.sub(
-        r"(January|February|March|April|May|June|July|August|"
-        r"September|October|November|December)",
-        lambda m: m.group(0).capitalize(),
-        event_date,
-        flags=re.IGNORECASE,
-    )
+    # The first date in the date segment, with the month name capitalised
+    date_match = segments[date_idx][1]
+    month = date_match.group("month")
+    event_date = _SPACED_HYPHEN_RE.sub("-", date_match.group("date")).strip()
+    event_date = event_date.replace(month, month.capitalize())
 
-    address = _resolve_address(venue_text)
+    year = date_match.group("year")
+    start_date = _event_day(date_match.group("start"), month, year, today)
+    end_date = _event_day(date_match.group("end") or date_match.group("start"), month, year, today)
 
     return {
         "title": title,
         "venue": venue_text,
-        "address": address,
+        "address": _resolve_address(venue_text),
         "event_date": event_date,
+        "start_date": start_date,
+        "end_date": end_date,
     }
 
 
+def parse_many(subjects, today: date | None = None) -> list[dict | None]:
+    """Parse many subject lines, e.g. to re-parse the whole subject cache after a rule change."""
+    if today is None:
+        today = date.today()
+    return [parse_event_subject(subject, today) for subject in subjects]
+
+
 def process_events_documents(path: str) -> list[dict]:
     """Extract event data from the subject line of an events email.
 
@@ -188,32 +244,21 @@ def process_events_documents(path: str) -> list[dict]:
     event_date = parsed["event_date"]
 
     # For date ranges like "13-15 April 2026", use the end date for expiry check
-    end_date_match = re.search(
-        r"(\d{1,2}(?:st|nd|rd|th)?)\s+"
-        r"(January|February|March|April|May|June|July|August|September|October|November|December)"
-        r"(?:\s+(\d{4}))?",
-        event_date,
-        re.IGNORECASE,
-    )
-    if not end_date_match:
+    end_date = parsed["end_date"]
+    if not end_date:
         print(f"\n{email_id}: WARNING - could not extract date from '{event_date}' for expiry check")
-    if end_date_match:
-        day = re.sub(r"(st|nd|rd|th)$", "", end_date_match.group(1), flags=re.IGNORECASE)
-        month = end_date_match.group(2).capitalize()
-        year = end_date_match.group(3) or ""
-        end_date_str = f"{day} {month} {year}".strip()
-        try:
-            if expired_date(end_date_str):
-                print(f"\n{email_id}: DELETING - event date {event_date} expired")
-                shutil.rmtree(path)
-                return []
-        except Exception as e:
-            print(f"\n{email_id}: WARNING - could not check expiry for date '{event_date}': {e}")
+    elif is_expired(end_date):
+        print(f"\n{email_id}: DELETING - event date {event_date} expired")
+        expire(path, end_date)
+        return []
+    else:
+        # so retention can prune the folder later without parsing it again
+        record_closing_date(path, end_date)
 
     # Description: event name + venue for context
     description = f"{title} at {parsed['venue']}"
 
-    file_link = upload_files(path, "Events Permit", address)
+    file_link = enqueue(path, "Events Permit", address)
 
     print(f"\n{subject}:")
     print(f"    Title:       {title}")
@@ -222,23 +267,42 @@ def process_events_documents(path: str) -> list[dict]:
     print(f"    Date:        {event_date}")
 
     return [{
+        "email_id": email_id,
         "filename": subject,
         "address": address,
         "title": title,
         "description": description,
         "closing_date": event_date,
+        "end_date": end_date.isoformat() if end_date else "",
         "file_link": file_link,
     }]
 
 
 def process_all_events(directory: str) -> list[dict]:
     """Loop through events email directories and extract data from subject lines."""
+    # sorted so the exported rows keep the same order between runs
+    paths = [
+        os.path.join(directory, email_id)
+        for email_id in sorted(os.listdir(directory))
+        if os.path.isdir(os.path.join(directory, email_id))
+    ]
+
     data = []
-    for email_id in os.listdir(directory):
-        full_path = os.path.join(directory, email_id)
-        if os.path.isdir(full_path):
-            result = process_events_documents(full_path)
-            data.extend(result)
+    for result in parallel_map(process_events_documents, paths):
+        data.extend(result)
 
     print(f"Got {len(data)} {directory} items")
     return data
+
+
+if __name__ == "__main__":
+    # re-parse every cached subject, e.g. to check a parsing rule change
+    import time
+
+    with open(CACHE_FILE, "r") as f:
+        subjects = list(json.load(f).values())
+    start = time.perf_counter()
+    results = parse_many(subjects)
+    elapsed = time.perf_counter() - start
+    parsed_count = sum(1 for result in results if result)
+    print(f"Parsed {parsed_count}/{len(subjects)} subjects in {elapsed * 1000:.1f}ms")
@@ -0,0 +1,289 @@
+"""Persistent store of the extracted map records with an indexed query api"""
+
+import os
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, fields, astuple
+from datetime import date
+from address_to_pin import cached_coordinates
+
+RECORDS_DB = os.environ.get("RECORDS_DB", "records.db")
+CATEGORIES = ("notice", "public", "events")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    category TEXT NOT NULL,
+    key TEXT NOT NULL,
+    email_id TEXT,
+    filename TEXT,
+    address TEXT,
+    suburb TEXT,
+    title TEXT,
+    description TEXT,
+    closing_date TEXT,
+    closing TEXT,
+    latitude REAL,
+    longitude REAL,
+    file_link TEXT,
+    PRIMARY KEY (category, key)
+);
+CREATE INDEX IF NOT EXISTS records_closing ON records (closing);
+CREATE INDEX IF NOT EXISTS records_suburb ON records (suburb COLLATE NOCASE, closing);
+CREATE INDEX IF NOT EXISTS records_category ON records (category, closing);
+CREATE TABLE IF NOT EXISTS versions (
+    category TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+
+
+def suburb_of(address):
+    """The suburb part of a formatted address, like '1 Long Street, Gardens, Cape Town'"""
+    parts = [part.strip() for part in (address or "").split(",")]
+    return parts[1] if len(parts) > 2 else ""
+
+
+def closing_of(item):
+    """The closing date (end date for events) of an item as an iso date, or None"""
+    from process_documents import parse_date
+
+    if item.get("end_date"):
+        return item["end_date"]
+    try:
+        return parse_date(item.get("closing_date") or "").isoformat()
+    except ValueError:
+        return None
+
+
+@dataclass(slots=True)
+class Record:
+    """One point on the map, from one email"""
+
+    category: str
+    key: str
+    email_id: str
+    filename: str
+    address: str
+    suburb: str
+    title: str
+    description: str
+    # closing date as written in the notice, closing is the parsed iso date
+    closing_date: str
+    closing: str | None
+    latitude: float | None
+    longitude: float | None
+    file_link: str
+
+    @classmethod
+    def from_item(cls, category, item, coordinates_cache):
+        """The record of an item, with coordinates from the item or the geocoding cache"""
+        from export_map_data import item_key
+
+        address = item.get("address", "") or ""
+        coordinates = item.get("coordinates") or coordinates_cache.get(address) or {}
+        return cls(
+            category=category,
+            key=item_key(item),
+            email_id=item.get("email_id", "") or "",
+            filename=item.get("filename", "") or "",
+            address=address,
+            suburb=suburb_of(address),
+            title=item.get("title", "") or "",
+            description=item.get("description", "") or "",
+            closing_date=item.get("closing_date", "") or "",
+            closing=closing_of(item),
+            latitude=coordinates.get("latitude"),
+            longitude=coordinates.get("longitude"),
+            file_link=item.get("file_link", "") or "",
+        )
+
+    def to_item(self):
+        """The item dict the exporters take"""
+        item = {
+            "email_id": self.email_id,
+            "filename": self.filename,
+            "address": self.address,
+            "title": self.title,
+            "description": self.description,
+            "closing_date": self.closing_date,
+            "file_link": self.file_link,
+        }
+        if self.category == "events":
+            item["end_date"] = self.closing or ""
+        if self.latitude is not None and self.longitude is not None:
+            item["coordinates"] = {"latitude": self.latitude, "longitude": self.longitude}
+        return item
+
+
+COLUMNS = [f.name for f in fields(Record)]
+
+
+class RecordStore:
+    """
+    Records of every category in a sqlite database.
+
+    Each pipeline run replaces a category's records with what it extracted,
+    the daemon updates single emails, and the exporters and queries read the
+    records back without extracting anything again.
+    """
+
+    def __init__(self, path=RECORDS_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _write(self, conn, category, records, delete_where, params):
+        """Replace the rows matching delete_where, return the number of rows that changed"""
+        existing = {
+            row[1]: row
+            for row in conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM records WHERE category = ? AND {delete_where}",
+                (category, *params),
+            )
+        }
+        rows = {record.key: astuple(record) for record in records}
+        stale = [key for key in existing if key not in rows]
+        changed = [row for key, row in rows.items() if existing.get(key) != row]
+        conn.executemany(
+            "DELETE FROM records WHERE category = ? AND key = ?", [(category, key) for key in stale]
+        )
+        conn.executemany(
+            f"INSERT OR REPLACE INTO records ({', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(COLUMNS))})",
+            changed,
+        )
+        if stale or changed:
+            self._bump_version(conn, category)
+        return len(stale) + len(changed)
+
+    def _bump_version(self, conn, category):
+        # readers cache a category until its version changes
+        conn.execute(
+            "INSERT INTO versions (category, version) VALUES (?, 1) "
+            "ON CONFLICT (category) DO UPDATE SET version = version + 1",
+            (category,),
+        )
+
+    def _records(self, category, items):
+        # the coordinates cache is read once, not for every record
+        coordinates_cache = cached_coordinates()
+        return [Record.from_item(category, item, coordinates_cache) for item in items if item.get("address")]
+
+    def replace_category(self, category, items):
+        """Make the category's records exactly these items, return the number of rows that changed"""
+        records = self._records(category, items)
+        with self._lock, self._connect() as conn:
+            return self._write(conn, category, records, "1", ())
+
+    def replace_email(self, category, email_id, items):
+        """Replace the records of one email, return the number of rows that changed"""
+        records = self._records(category, items)
+        with self._lock, self._connect() as conn:
+            return self._write(conn, category, records, "email_id = ?", (email_id,))
+
+    def query(self, category=None, suburb=None, closing_from=None, closing_to=None, open_on=None):
+        """
+        Records matching every filter given, in export order.
+
+        closing_from and closing_to bound the closing date (inclusive), open_on
+        only keeps records that close on or after that date. Dates are date
+        objects or iso strings.
+        """
+        where, params = [], []
+        if category:
+            where.append("category = ?")
+            params.append(category)
+        if suburb:
+            where.append("suburb = ? COLLATE NOCASE")
+            params.append(suburb)
+        if open_on:
+            closing_from = max(str(closing_from or ""), str(open_on))
+        if closing_from:
+            where.append("closing >= ?")
+            params.append(str(closing_from))
+        if closing_to:
+            where.append("closing <= ?")
+            params.append(str(closing_to))
+
+        sql = f"SELECT {', '.join(COLUMNS)} FROM records"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY category, email_id, key"
+        with self._connect() as conn:
+            return [Record(*row) for row in conn.execute(sql, params)]
+
+    def expiring(self, closing_to):
+        """Records closing on or before a date, soonest first"""
+        sql = (
+            f"SELECT {', '.join(COLUMNS)} FROM records "
+            "WHERE closing IS NOT NULL AND closing <= ? ORDER BY closing"
+        )
+        with self._connect() as conn:
+            return [Record(*row) for row in conn.execute(sql, (str(closing_to),))]
+
+    def next_closing(self):
+        """The earliest closing date in the store, or None"""
+        with self._connect() as conn:
+            return conn.execute("SELECT MIN(closing) FROM records").fetchone()[0]
+
+    def remove(self, category, keys):
+        """Delete records by key, return the number deleted"""
+        with self._lock, self._connect() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "DELETE FROM records WHERE category = ? AND key = ?", [(category, key) for key in keys]
+            )
+            removed = conn.total_changes - before
+            if removed:
+                self._bump_version(conn, category)
+            return removed
+
+    def versions(self):
+        """Version of each category, bumped whenever its records change"""
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT category, version FROM versions"))
+
+    def items(self, category):
+        """The category's records as the item dicts the exporters take"""
+        return [record.to_item() for record in self.query(category=category)]
+
+
+# shared store for the pipeline and exporters
+store = RecordStore()
+
+
+def save_category(category, items):
+    """Store a category's extracted items and return them as read back from the store"""
+    changed = store.replace_category(category, items)
+    print(f"Stored {category} records, {changed} changed")
+    return store.items(category)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the extracted map records")
+    parser.add_argument("--category", choices=CATEGORIES)
+    parser.add_argument("--suburb")
+    parser.add_argument("--closing-from", help="yyyy-mm-dd")
+    parser.add_argument("--closing-to", help="yyyy-mm-dd")
+    parser.add_argument("--open", action="store_true", help="only records still open today")
+    args = parser.parse_args()
+
+    records = store.query(
+        category=args.category, suburb=args.suburb, closing_from=args.closing_from,
+        closing_to=args.closing_to, open_on=date.today() if args.open else None,
+    )
+    for record in records:
+        print(f"{record.closing or '':<10}  {record.category:<6}  {record.suburb:<16}  {record.title}")
+    print(f"{len(records)} records")
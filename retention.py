@@ -0,0 +1,296 @@
+"""Prune expired email folders and compact the caches down to the live emails"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import threading
+from datetime import date
+from download_emails import (
+    NOTICE_DIR, PUBLIC_DIR, EVENTS_DIR, EXPIRED_FILE, CACHE_FILE as SUBJECTS_FILE, load_expired,
+    cuttoff_year, cuttoff_month, cuttoff_day,
+)
+from ai_summarise_descriptions import CACHE_FILE as SUMMARIES_FILE
+from ai_extract_address import CACHE_FILE as ADDRESSES_FILE
+from upload_gdrive import CACHE_FILE as SHORT_LINKS_FILE, PARENT_FOLDER_ID
+from upload_queue import DONE_DIR
+from fingerprints import index as fingerprints
+
+# closing date (end date for events) of every processed email folder
+CLOSING_DATES_FILE = "closing_dates.json"
+# defaults to the grace period the map uses
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", os.environ.get("EXPIRY_GRACE_DAYS", 10)))
+# main runs the retention job at most this often
+RETENTION_INTERVAL_HOURS = int(os.environ.get("RETENTION_INTERVAL_HOURS", 24))
+STAMP_FILE = "retention.stamp"
+# drive folder the folders of pruned emails are moved to with --archive
+ARCHIVE_FOLDER_ID = os.environ.get("ARCHIVE_FOLDER_ID")
+EMAIL_DIRS = (NOTICE_DIR, PUBLIC_DIR, EVENTS_DIR)
+DRIVE_FOLDER_URL = "https://drive.google.com/drive/folders/"
+# the hubspot search never finds emails sent before this again
+SEARCH_CUTOFF = date(cuttoff_year, cuttoff_month, cuttoff_day).isoformat()
+_lock = threading.Lock()
+
+
+def _load_json(path):
+    try:
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                return json.load(f)
+    except:
+        pass
+    return {}
+
+
+def _save_json(path, data):
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_file, path)
+
+
+def _file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def dir_size(path):
+    """Bytes used by the files in a directory"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def human_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+
+
+def record_closing_date(path, closing_date):
+    """Remember when an email folder expires, so it can be pruned without parsing it again"""
+    key = os.path.normpath(str(path))
+    value = closing_date.isoformat()
+    with _lock:
+        closing_dates = _load_json(CLOSING_DATES_FILE)
+        if closing_dates.get(key) == value:
+            return
+        closing_dates[key] = value
+        _save_json(CLOSING_DATES_FILE, closing_dates)
+
+
+def expire(path, closing_date=None):
+    """
+    Delete an expired email folder and return the bytes reclaimed.
+
+    The email id is added to the expired emails so the download step
+    doesn't fetch it again, with the closing date (or today) as a date the
+    email was sent before, so the entry can be dropped once it is older
+    than the search cutoff.
+    """
+    key = os.path.normpath(str(path))
+    size = dir_size(key)
+    shutil.rmtree(key, ignore_errors=True)
+    with _lock:
+        expired = load_expired()
+        expired[os.path.basename(key)] = (closing_date or date.today()).isoformat()
+        _save_json(EXPIRED_FILE, expired)
+
+        closing_dates = _load_json(CLOSING_DATES_FILE)
+        if closing_dates.pop(key, None) is not None:
+            _save_json(CLOSING_DATES_FILE, closing_dates)
+    return size
+
+
+def live_paths():
+    """The email folders still on disk"""
+    paths = set()
+    for directory in EMAIL_DIRS:
+        if os.path.isdir(directory):
+            for email_id in os.listdir(directory):
+                path = os.path.join(directory, email_id)
+                if os.path.isdir(path):
+                    paths.add(os.path.normpath(path))
+    return paths
+
+
+def _is_live(key, live):
+    """Cache keys under an email folder are live while the folder exists, anything else is kept"""
+    parts = os.path.normpath(str(key)).split(os.sep)
+    if len(parts) < 2 or parts[0] not in EMAIL_DIRS:
+        return True
+    return os.path.join(parts[0], parts[1]) in live
+
+
+def prune_expired(days=RETENTION_DAYS, dry_run=False):
+    """Delete the email folders more than days past their recorded closing date"""
+    from process_documents import is_expired
+
+    pruned = []
+    reclaimed = 0
+    for path, closing in sorted(_load_json(CLOSING_DATES_FILE).items()):
+        closing_date = date.fromisoformat(closing)
+        if not is_expired(closing_date, days) or not os.path.isdir(path):
+            continue
+        reclaimed += dir_size(path) if dry_run else expire(path, closing_date)
+        pruned.append(path)
+    return pruned, reclaimed
+
+
+def compact_json(path, keep, dry_run=False):
+    """Drop the entries of a json cache that keep(key, value) rejects, return (entries, bytes) removed"""
+    cache = _load_json(path)
+    if not cache:
+        return 0, 0
+    compacted = {key: value for key, value in cache.items() if keep(key, value)}
+    removed = len(cache) - len(compacted)
+    if not removed:
+        return 0, 0
+    if dry_run:
+        return removed, 0
+    before = _file_size(path)
+    _save_json(path, compacted)
+    return removed, before - _file_size(path)
+
+
+def keep_tombstone(_, sent_before):
+    """Expired emails sent before the search cutoff are never found again, their entries can go"""
+    return not sent_before or sent_before >= SEARCH_CUTOFF
+
+
+def stale_uploads(live):
+    """The done upload jobs of email folders that no longer exist, as (job file, link)"""
+    stale = []
+    if os.path.isdir(DONE_DIR):
+        for name in os.listdir(DONE_DIR):
+            job_file = os.path.join(DONE_DIR, name)
+            job = _load_json(job_file)
+            if job and not _is_live(job.get("path", ""), live):
+                stale.append((job_file, job.get("link") or ""))
+    return stale
+
+
+def live_links(live):
+    """Links still used by the map, an upload can be shared by several notices"""
+    from records_store import store
+
+    links = {record.file_link for record in store.query() if record.file_link}
+    if os.path.isdir(DONE_DIR):
+        for name in os.listdir(DONE_DIR):
+            job = _load_json(os.path.join(DONE_DIR, name))
+            if job and job.get("link") and _is_live(job.get("path", ""), live):
+                links.add(job["link"])
+    return links
+
+
+def archive_drive_folders(links, dry_run=False):
+    """Move the drive folders behind the short links to the archive folder"""
+    if not ARCHIVE_FOLDER_ID:
+        print("ARCHIVE_FOLDER_ID not set, not archiving drive folders")
+        return 0
+
+    # short links map back to folders through the drive url entries of the link cache
+    short_links = _load_json(SHORT_LINKS_FILE)
+    folder_ids = [
+        url[len(DRIVE_FOLDER_URL):]
+        for url, short in short_links.items()
+        if url.startswith(DRIVE_FOLDER_URL) and short in links
+    ]
+    if dry_run or not folder_ids:
+        return len(folder_ids)
+
+    from upload_gdrive import authenticate
+    service = authenticate()
+    for folder_id in folder_ids:
+        try:
+            service.files().update(
+                fileId=folder_id, addParents=ARCHIVE_FOLDER_ID, removeParents=PARENT_FOLDER_ID,
+                fields="id",
+            ).execute()
+        except Exception as e:
+            print(f"Error archiving drive folder {folder_id}: {e}")
+    return len(folder_ids)
+
+
+def run_retention(days=RETENTION_DAYS, archive=False, dry_run=False):
+    """Prune the expired email folders, compact the caches and report what was reclaimed"""
+    print(f"Retention{' (dry run)' if dry_run else ''}: pruning emails {days} days past closing")
+    pruned, reclaimed = prune_expired(days, dry_run)
+    print(f"    email folders:       {len(pruned)} pruned, {human_size(reclaimed)}")
+
+    live = live_paths()
+    if dry_run:
+        live -= set(pruned)
+
+    # duplicates of a pruned notice share its closing date
+    orphans = [] if dry_run else fingerprints.compact(live)
+    reclaimed = sum(expire(path) for path in orphans)
+    live -= set(orphans)
+    print(f"    duplicate folders:   {len(orphans)} pruned, {human_size(reclaimed)}")
+    live_ids = {os.path.basename(path) for path in live}
+
+    # links of the uploads for folders that are gone
+    stale = stale_uploads(live)
+    # an uploaded folder reused for another notice stays while that one is live
+    dead_links = {link for _, link in stale if link} - live_links(live)
+    if archive:
+        archived = archive_drive_folders(dead_links, dry_run)
+        print(f"    drive folders:       {archived} archived")
+
+    caches = [
+        (SUMMARIES_FILE, lambda key, _: _is_live(key, live)),
+        (ADDRESSES_FILE, lambda key, _: _is_live(key, live)),
+        (SUBJECTS_FILE, lambda key, _: key in live_ids),
+        (SHORT_LINKS_FILE, lambda _, link: link not in dead_links),
+        (CLOSING_DATES_FILE, lambda key, _: _is_live(key, live)),
+        (EXPIRED_FILE, keep_tombstone),
+    ]
+    for path, keep in caches:
+        removed, saved = compact_json(path, keep, dry_run)
+        print(f"    {path + ':':<20} {removed} entries, {human_size(saved)}")
+
+    saved = 0
+    for job_file, _ in stale:
+        saved += _file_size(job_file)
+        if not dry_run:
+            os.remove(job_file)
+    print(f"    {'upload jobs:':<20} {len(stale)} entries, {human_size(saved)}")
+
+    if not dry_run:
+        with open(STAMP_FILE, "w") as f:
+            f.write(str(time.time()))
+
+
+def retention_due(interval_hours=RETENTION_INTERVAL_HOURS):
+    """True when the retention job hasn't run in the last interval"""
+    try:
+        with open(STAMP_FILE, "r") as f:
+            last_run = float(f.read().strip())
+    except (OSError, ValueError):
+        return True
+    return time.time() - last_run > interval_hours * 3600
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prune expired emails and compact the caches")
+    parser.add_argument(
+        "--days", type=int, default=RETENTION_DAYS,
+        help="days after the closing date an email is kept",
+    )
+    parser.add_argument(
+        "--archive", action="store_true",
+        help="move the drive folders of pruned emails to ARCHIVE_FOLDER_ID",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="only report what would be pruned",
+    )
+    args = parser.parse_args()
+
+    run_retention(args.days, archive=args.archive, dry_run=args.dry_run)
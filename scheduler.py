@@ -0,0 +1,134 @@
+"""Run the pipeline stages as a small task graph with per-resource concurrency limits"""
+
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+
+# maximum number of concurrent users of each shared resource
+RESOURCE_LIMITS = {
+    "cpu": int(os.environ.get("CPU_WORKERS", os.cpu_count() or 2)),
+    "gemini": int(os.environ.get("GEMINI_SLOTS", 2)),
+    "drive": int(os.environ.get("DRIVE_SLOTS", 2)),
+}
+_semaphores = {name: threading.BoundedSemaphore(max(1, n)) for name, n in RESOURCE_LIMITS.items()}
+
+
+@contextmanager
+def limit(resource):
+    """Hold one slot of a shared resource for the duration of the block"""
+    semaphore = _semaphores.get(resource)
+    if semaphore is None:
+        yield
+        return
+    with semaphore:
+        yield
+
+
+def parallel_map(func, items, workers=None):
+    """Apply func to every item concurrently and return the results in input order"""
+    items = list(items)
+    if not items:
+        return []
+    if workers is None:
+        workers = sum(RESOURCE_LIMITS.values())
+    workers = max(1, min(workers, len(items)))
+    if workers == 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items))
+
+
+class Task:
+    """A named unit of work that runs once all of its dependencies have finished"""
+
+    def __init__(self, name, func, deps=(), resource=None):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.resource = resource
+
+    def run(self, results):
+        args = [results[dep] for dep in self.deps]
+        with limit(self.resource):
+            return self.func(*args)
+
+
+class TaskGraph:
+    """
+    Dependency graph of pipeline stages.
+
+    Each task is called with the results of its dependencies as positional
+    arguments, in the order the dependencies were declared. Independent tasks
+    run concurrently; a failed task is reported and its dependents are skipped.
+    Cleanup functions run after every task, whether they failed or not.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.cleanups = []
+
+    def add(self, name, func, deps=(), resource=None):
+        if name in self.tasks:
+            raise ValueError(f"Duplicate task: {name}")
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError(f"Task {name} depends on unknown task {dep}")
+        self.tasks[name] = Task(name, func, deps, resource)
+        return self.tasks[name]
+
+    def add_cleanup(self, func):
+        """Call func() once the run is over, even when tasks failed"""
+        self.cleanups.append(func)
+
+    def run(self, max_workers=None):
+        """Run every task and return a dict of task name to result, in declaration order"""
+        if max_workers is None:
+            max_workers = len(self.tasks) or 1
+
+        try:
+            return self._run(max_workers)
+        finally:
+            for cleanup in self.cleanups:
+                try:
+                    cleanup()
+                except Exception:
+                    print("Error in pipeline cleanup")
+                    traceback.print_exc()
+
+    def _run(self, max_workers):
+        results = {}
+        failed = set()
+        pending = dict(self.tasks)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while pending or running:
+                # skip anything downstream of a failure
+                for name, task in list(pending.items()):
+                    if any(dep in failed for dep in task.deps):
+                        print(f"Skipping {name}: dependency failed")
+                        failed.add(name)
+                        del pending[name]
+
+                # start every task whose dependencies are complete
+                for name, task in list(pending.items()):
+                    if all(dep in results for dep in task.deps):
+                        running[pool.submit(task.run, results)] = name
+                        del pending[name]
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception:
+                        print(f"Error in task {name}")
+                        traceback.print_exc()
+                        failed.add(name)
+
+        return {name: results[name] for name in self.tasks if name in results}
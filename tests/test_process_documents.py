@@ -0,0 +1,36 @@
+import process_documents
+
+
+def test_single_notice_pdf_is_parsed(tmp_path, monkeypatch):
+    """A folder holding only the notice pdf, the other attachments deferred, still gives its item"""
+    monkeypatch.chdir(tmp_path)
+    email_dir = tmp_path / "12345"
+    email_dir.mkdir()
+    (email_dir / "notice.pdf").write_bytes(b"%PDF-1.4")
+
+    parsed_files = []
+
+    def parse_pdf(pdf_file, parser):
+        parsed_files.append(pdf_file.name)
+        return {
+            "closing_date": "1 January 2099",
+            "expired": False,
+            "address": "12 Kloof Street, Gardens",
+            "description": "Application for a departure from the building lines.",
+            "erf_text": "",
+        }
+
+    monkeypatch.setattr(process_documents, "parse_pdf", parse_pdf)
+    monkeypatch.setattr(process_documents.fingerprints, "add_files", lambda path, is_notice: None)
+    monkeypatch.setattr(process_documents.fingerprints, "add_text", lambda path, text: None)
+    monkeypatch.setattr(process_documents, "record_closing_date", lambda path, closing: None)
+    monkeypatch.setattr(process_documents, "summarise", lambda text, description_id: text)
+    monkeypatch.setattr(process_documents, "enqueue", lambda path, pdf_file, address: "https://drive/notice")
+
+    items = process_documents.process_documents(str(email_dir), subject="Notice Erf 1234")
+
+    assert parsed_files == ["notice.pdf"]
+    assert len(items) == 1
+    assert items[0]["filename"] == "notice.pdf"
+    assert items[0]["address"] == "12 Kloof Street, Gardens"
+    assert items[0]["file_link"] == "https://drive/notice"
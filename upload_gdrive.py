@@ -12,52 +12,77 @@ from googleapiclient.errors import HttpError
 from google.auth.exceptions import RefreshError
 import pathlib
 import requests
+import threading
 from datetime import datetime
+from scheduler import limit
+from download_emails import DEFERRED_FILE, fetch_deferred
+from drive_index import index as drive_index, file_md5
 
 # folder to create new folders under
 PARENT_FOLDER_ID = os.environ.get("PARENT_FOLDER_ID")
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 CACHE_FILE = "short_links.json"
+_cache_lock = threading.Lock()
+_auth_lock = threading.Lock()
+# drive services aren't thread safe, so each thread keeps its own warm one
+_local = threading.local()
 
 
 def authenticate():
     """Authenticate using OAuth (works with token file for headless)."""
-    creds = None
-    # token.pickle stores the user's access and refresh tokens
-    if os.path.exists("token.pickle"):
-        with open("token.pickle", "rb") as token:
-            creds = pickle.load(token)
-
-    # If there are no valid credentials, let the user log in
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-                # Save refreshed token
+    # reuse this thread's service while its credentials are still valid
+    creds = getattr(_local, "creds", None)
+    if creds and creds.valid:
+        return _local.service
+
+    # token.pickle is shared, so only one worker refreshes it at a time
+    with _auth_lock:
+        creds = None
+        # token.pickle stores the user's access and refresh tokens
+        if os.path.exists("token.pickle"):
+            with open("token.pickle", "rb") as token:
+                creds = pickle.load(token)
+
+        # If there are no valid credentials, let the user log in
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                try:
+                    creds.refresh(Request())
+                    # Save refreshed token
+                    with open("token.pickle", "wb") as token:
+                        pickle.dump(creds, token)
+                except RefreshError as e:
+                    print(f"Token expired - please rerun the script and log in again")
+                    os.remove("token.pickle")
+                    raise
+                except Exception as e:
+                    print(f"Error refreshing token: {e}")
+                    os.remove("token.pickle")
+                    raise
+            else:
+                # This requires a browser
+                flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
+                creds = flow.run_local_server(port=0)
+
+                # Save the credentials for the next run
                 with open("token.pickle", "wb") as token:
                     pickle.dump(creds, token)
-            except RefreshError as e:
-                print(f"Token expired - please rerun the script and log in again")
-                os.remove("token.pickle")
-                raise
-            except Exception as e:
-                print(f"Error refreshing token: {e}")
-                os.remove("token.pickle")
-                raise
-        else:
-            # This requires a browser
-            flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
-            creds = flow.run_local_server(port=0)
-
-            # Save the credentials for the next run
-            with open("token.pickle", "wb") as token:
-                pickle.dump(creds, token)
-
-    return build("drive", "v3", credentials=creds)
+
+        _local.creds = creds
+        _local.service = build("drive", "v3", credentials=creds)
+        return _local.service
 
 
 def create_folder(service, folder_name, parent_id=None):
     """Create a folder in Google Drive if it doesn't already exist."""
+    # folders under the parent folder are looked up in the local index
+    indexed = drive_index.synced and parent_id == drive_index.parent_id
+    if indexed:
+        folder_id = drive_index.folder_id(folder_name)
+        if folder_id:
+            return folder_id
+        return _new_folder(service, folder_name, parent_id)
+
     escaped_name = folder_name.replace("\\", "\\\\").replace("'", "\\'")
     query = f"name = '{escaped_name}' and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
     if parent_id:
@@ -69,6 +94,10 @@ def create_folder(service, folder_name, parent_id=None):
     if folders:
         folder_id = folders[0]["id"]
         return folder_id
+    return _new_folder(service, folder_name, parent_id)
+
+
+def _new_folder(service, folder_name, parent_id=None):
     file_metadata = {
         "name": folder_name,
         "mimeType": "application/vnd.google-apps.folder",
@@ -77,6 +106,8 @@ def create_folder(service, folder_name, parent_id=None):
         file_metadata["parents"] = [parent_id]
 
     folder = service.files().create(body=file_metadata, fields="id, name").execute()
+    if parent_id == drive_index.parent_id:
+        drive_index.add_folder(folder["id"], folder["name"])
     return folder.get("id")
 
 
@@ -105,11 +136,14 @@ def upload_file(service, file_path, folder_id):
     """Upload a file to Google Drive if it doesn't already exist in the folder."""
 
     file_name = os.path.basename(file_path)
-    escaped_name = file_name.replace("\\", "\\\\").replace("'", "\\'")
     # Check if file already exists in folder
-    query = f"name = '{escaped_name}' and '{folder_id}' in parents and trashed = false"
-    results = service.files().list(q=query, fields="files(id, name)").execute()
-    files = results.get("files", [])
+    if drive_index.synced and folder_id in drive_index.folders:
+        files = drive_index.file_id(folder_id, file_name)
+    else:
+        escaped_name = file_name.replace("\\", "\\\\").replace("'", "\\'")
+        query = f"name = '{escaped_name}' and '{folder_id}' in parents and trashed = false"
+        results = service.files().list(q=query, fields="files(id, name)").execute()
+        files = results.get("files", [])
     # exist early
     if files:
         return
@@ -119,9 +153,10 @@ def upload_file(service, file_path, folder_id):
 
     file = (
         service.files()
-        .create(body=file_metadata, media_body=media, fields="id, name")
+        .create(body=file_metadata, media_body=media, fields="id, name, md5Checksum")
         .execute()
     )
+    drive_index.add_file(folder_id, file["id"], file["name"], file.get("md5Checksum"))
 
     return file.get("id")
 
@@ -144,7 +179,8 @@ def shorten_link(link):
     """Shorten the link to the gdive folder using tinyurl"""
 
     # free tier only allows 100 urls a month
-    cache = load_cache()
+    with _cache_lock:
+        cache = load_cache()
     if link in cache:
         return cache[link]
 
@@ -159,8 +195,10 @@ def shorten_link(link):
     response.raise_for_status()
     short_url = response.json()["data"]["tiny_url"]
 
-    cache[link] = short_url
-    save_cache(cache)
+    with _cache_lock:
+        cache = load_cache()
+        cache[link] = short_url
+        save_cache(cache)
 
     return short_url
 
@@ -182,12 +220,43 @@ def upload_files(local_folder_path, pdf_file, address):
     if suburb:
         folder_name = f"{suburb} - {folder_name}"
 
-    cache = load_cache()
+    with _cache_lock:
+        cache = load_cache()
     if folder_name in cache:
         return cache[folder_name]
 
+    # the same notice was uploaded before, maybe on another day
+    link = uploaded_link(local_folder_path, pdf_file, cache)
+    if link:
+        with _cache_lock:
+            cache = load_cache()
+            cache[folder_name] = link
+            save_cache(cache)
+        return link
+
+    with limit("drive"):
+        return _upload_folder(local_folder_path, folder_name)
+
+
+def uploaded_link(local_folder_path, pdf_file, cache):
+    """
+    Short link of an indexed drive folder that already holds the notice pdf.
+    Only the notice is matched, generic attachments are shared by unrelated notices.
+    """
+    file_path = os.path.join(local_folder_path, os.path.basename(str(pdf_file)))
+    if not os.path.isfile(file_path):
+        return None
+    folder_id = drive_index.folder_with_md5(file_md5(file_path))
+    if folder_id:
+        return cache.get(f"https://drive.google.com/drive/folders/{folder_id}")
+    return None
+
+
+def _upload_folder(local_folder_path, folder_name):
+    """Upload the local folder contents to a new drive folder and cache the public link"""
     # Authenticate
     service = authenticate()
+    drive_index.sync(service)
 
     # Create folder in Google Drive
     folder_id = create_folder(service, folder_name, PARENT_FOLDER_ID)
@@ -197,10 +266,13 @@ def upload_files(local_folder_path, pdf_file, address):
         print(f"Error: Local folder '{local_folder_path}' does not exist.")
         return
 
+    # download the attachments that were skipped until now
+    fetch_deferred(local_folder_path)
+
     files = [
         f
         for f in os.listdir(local_folder_path)
-        if os.path.isfile(os.path.join(local_folder_path, f))
+        if os.path.isfile(os.path.join(local_folder_path, f)) and f != DEFERRED_FILE
     ]
 
     if not files:
@@ -219,7 +291,10 @@ def upload_files(local_folder_path, pdf_file, address):
             print(f"Error uploading {file_name}: {str(e)}")
 
     print(f"Done {local_folder_path}")
+    drive_index.save()
     link = make_public_link(service, folder_id)
-    cache[folder_name] = link
-    save_cache(cache)
+    with _cache_lock:
+        cache = load_cache()
+        cache[folder_name] = link
+        save_cache(cache)
     return link
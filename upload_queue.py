@@ -0,0 +1,242 @@
+"""Durable on-disk queue of drive upload jobs, drained by background workers"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import traceback
+from scheduler import RESOURCE_LIMITS
+
+QUEUE_DIR = "upload_queue"
+PENDING_DIR = os.path.join(QUEUE_DIR, "pending")
+RUNNING_DIR = os.path.join(QUEUE_DIR, "running")
+DONE_DIR = os.path.join(QUEUE_DIR, "done")
+FAILED_DIR = os.path.join(QUEUE_DIR, "failed")
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 5
+
+
+def job_id(path):
+    """Jobs are keyed by the email folder, so each folder is uploaded once"""
+    return hashlib.sha1(os.path.normpath(str(path)).encode("utf-8")).hexdigest()[:16]
+
+
+def _read_job(job_file):
+    try:
+        with open(job_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_job(job_file, job):
+    """Write a job file atomically"""
+    os.makedirs(os.path.dirname(job_file), exist_ok=True)
+    tmp_file = job_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(job, f, indent=2)
+    os.replace(tmp_file, job_file)
+
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def enqueue(path, pdf_file, address):
+    """
+    Queue the upload of an email folder and return its link if it was already uploaded.
+
+    Returns an empty string while the upload is still pending, the export
+    picks up the link once a worker has finished it.
+    """
+    key = job_id(path)
+    done = _read_job(os.path.join(DONE_DIR, f"{key}.json"))
+    if done:
+        return done.get("link") or ""
+    if os.path.exists(os.path.join(FAILED_DIR, f"{key}.json")):
+        # failed jobs stay put until they are moved back to pending by hand
+        return ""
+
+    job = {
+        "id": key,
+        "path": str(path),
+        "pdf_file": str(pdf_file),
+        "address": address,
+        "attempts": 0,
+        "queued": time.time(),
+    }
+    pending_file = os.path.join(PENDING_DIR, f"{key}.json")
+    if not os.path.exists(pending_file):
+        _write_job(pending_file, job)
+    return ""
+
+
+def job_link(path):
+    """The uploaded link for an email folder, or an empty string if it isn't done yet"""
+    done = _read_job(os.path.join(DONE_DIR, f"{job_id(path)}.json"))
+    return (done or {}).get("link") or ""
+
+
+def resolve_links(document_data, directory):
+    """Fill in the links of the items whose uploads finished after they were extracted"""
+    for item in document_data:
+        if not item.get("file_link") and item.get("email_id"):
+            item["file_link"] = job_link(os.path.join(directory, item["email_id"]))
+    return document_data
+
+
+def queued(directory):
+    """Number of pending and running jobs for the email folders in a directory"""
+    directory = os.path.normpath(directory)
+    count = 0
+    for queue_dir in (PENDING_DIR, RUNNING_DIR):
+        if not os.path.isdir(queue_dir):
+            continue
+        for name in os.listdir(queue_dir):
+            if not name.endswith(".json"):
+                continue
+            job = _read_job(os.path.join(queue_dir, name))
+            if job and os.path.dirname(os.path.normpath(job["path"])) == directory:
+                count += 1
+    return count
+
+
+def recover():
+    """Requeue the jobs claimed by workers that are no longer running"""
+    if not os.path.isdir(RUNNING_DIR):
+        return
+    for name in os.listdir(RUNNING_DIR):
+        if not name.endswith(".json"):
+            continue
+        # running jobs are named <id>.<pid>.json
+        key, pid, _ = name.rsplit(".", 2)
+        if pid.isdigit() and _pid_running(int(pid)):
+            continue
+        try:
+            os.rename(os.path.join(RUNNING_DIR, name), os.path.join(PENDING_DIR, f"{key}.json"))
+        except OSError:
+            pass
+
+
+def claim():
+    """Take a pending job, or return None when the queue is empty"""
+    if not os.path.isdir(PENDING_DIR):
+        return None
+    os.makedirs(RUNNING_DIR, exist_ok=True)
+    for name in sorted(os.listdir(PENDING_DIR)):
+        if not name.endswith(".json"):
+            continue
+        key = name[:-len(".json")]
+        running_file = os.path.join(RUNNING_DIR, f"{key}.{os.getpid()}.json")
+        try:
+            # the rename is atomic, so only one worker gets each job
+            os.rename(os.path.join(PENDING_DIR, name), running_file)
+        except OSError:
+            continue
+        job = _read_job(running_file)
+        if job:
+            return job, running_file
+        os.remove(running_file)
+    return None
+
+
+def run_job(job, running_file):
+    """Upload one job's folder and file it as done, or retry it later"""
+    from upload_gdrive import upload_files
+
+    try:
+        link = upload_files(job["path"], job["pdf_file"], job["address"])
+    except Exception as e:
+        traceback.print_exc()
+        job["attempts"] += 1
+        job["error"] = str(e)
+        target = FAILED_DIR if job["attempts"] >= MAX_ATTEMPTS else PENDING_DIR
+        _write_job(os.path.join(target, f"{job['id']}.json"), job)
+        os.remove(running_file)
+        print(f"Upload of {job['path']} failed ({job['attempts']}/{MAX_ATTEMPTS}): {e}")
+        return None
+
+    job["link"] = link or ""
+    job["finished"] = time.time()
+    _write_job(os.path.join(DONE_DIR, f"{job['id']}.json"), job)
+    os.remove(running_file)
+    return link
+
+
+def drain():
+    """Run jobs until the queue is empty"""
+    while True:
+        claimed = claim()
+        if not claimed:
+            return
+        run_job(*claimed)
+
+
+class UploadWorkers:
+    """
+    Background threads that drain the queue while extraction keeps going.
+
+    The workers poll for new jobs until finish() is called, then empty the
+    queue and exit.
+    """
+
+    def __init__(self, workers=None, poll_interval=1):
+        self.workers = workers or RESOURCE_LIMITS["drive"]
+        self.poll_interval = poll_interval
+        self._finishing = threading.Event()
+        self._threads = []
+
+    def start(self):
+        recover()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"upload-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def _run(self):
+        while True:
+            drain()
+            if self._finishing.is_set():
+                return
+            self._finishing.wait(self.poll_interval)
+
+    def wait_for(self, directory):
+        """Wait until the queued uploads of one directory are finished"""
+        while queued(directory) and any(thread.is_alive() for thread in self._threads):
+            time.sleep(self.poll_interval)
+
+    def finish(self):
+        """Wait for every queued upload to finish"""
+        self._finishing.set()
+        for thread in self._threads:
+            thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload the queued email folders to google drive")
+    parser.add_argument(
+        "--watch", action="store_true",
+        help=f"keep polling for new jobs every {POLL_INTERVAL}s",
+    )
+    args = parser.parse_args()
+
+    recover()
+    while True:
+        drain()
+        if not args.watch:
+            break
+        time.sleep(POLL_INTERVAL)
+
+    failed = len(os.listdir(FAILED_DIR)) if os.path.isdir(FAILED_DIR) else 0
+    print(f"Upload queue empty, {failed} failed jobs in {FAILED_DIR}")
+    sys.exit(1 if failed else 0)
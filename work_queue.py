@@ -0,0 +1,323 @@
+"""Share the emails of a backfill between worker nodes with a leased sqlite queue"""
+
+import os
+import json
+import time
+import fcntl
+import socket
+import sqlite3
+import argparse
+import threading
+import traceback
+from contextlib import contextmanager
+from datetime import date
+from download_emails import (
+    find_emails, download_email, remember_subject, NOTICE_DIR, PUBLIC_DIR, EVENTS_DIR,
+)
+from process_documents import process_documents, parse_date, is_expired
+from process_events_documents import process_events_documents
+from upload_queue import drain as drain_uploads, resolve_links
+from export_map_data import export_to_map_csv
+from records_store import save_category
+from scheduler import RESOURCE_LIMITS
+
+# on storage every node can reach, sqlite locks the whole file for each write
+QUEUE_DB = os.environ.get("WORK_QUEUE_DB", "work_queue.db")
+# a lease not renewed for this long is given to another worker
+LEASE_SECONDS = int(os.environ.get("WORK_LEASE_SECONDS", 300))
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 5
+# only the queue database is shared. The json caches and the upload queue in the
+# working directory are guarded by thread locks, so one worker process per directory.
+WORKER_LOCK_FILE = "work_queue.lock"
+CATEGORIES = {NOTICE_DIR: "notice", PUBLIC_DIR: "public", EVENTS_DIR: "events"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    email_id TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    email TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    lease_owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS items_status ON items (status, lease_expires);
+"""
+
+
+class WorkQueue:
+    """
+    Queue of emails to download, extract and upload, shared by several workers.
+
+    A worker leases items for LEASE_SECONDS and renews the lease while it
+    works on them. Items whose lease runs out, because the worker died or
+    hung, are delivered to the next worker that asks. Results are only
+    accepted from the worker that holds the lease.
+    """
+
+    def __init__(self, path=QUEUE_DB, lease_seconds=LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction, taking the write lock up front so leases can't race"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, emails):
+        """Add (email, subject, directory) items, skipping emails already queued, return the count added"""
+        now = time.time()
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO items (email_id, directory, subject, email, updated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (email["id"], directory, subject, json.dumps(email), now)
+                    for email, subject, directory in emails
+                ],
+            )
+            return conn.total_changes - before
+
+    def lease(self, owner, count=1):
+        """Lease up to count pending or expired items, as (email, subject, directory)"""
+        now = time.time()
+        with self._transaction() as conn:
+            # items that keep killing their worker aren't handed out again
+            conn.execute(
+                "UPDATE items SET status = 'failed', error = 'lease expired', lease_owner = NULL "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, MAX_ATTEMPTS),
+            )
+            rows = conn.execute(
+                "SELECT email_id, directory, subject, email FROM items "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY rowid LIMIT ?",
+                (now, count),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE items SET status = 'leased', lease_owner = ?, lease_expires = ?, "
+                "attempts = attempts + 1, updated = ? WHERE email_id = ?",
+                [(owner, now + self.lease_seconds, now, row["email_id"]) for row in rows],
+            )
+        return [(json.loads(row["email"]), row["subject"], row["directory"]) for row in rows]
+
+    def renew(self, owner, email_ids):
+        """Extend the leases still held by owner"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE items SET lease_expires = ? "
+                "WHERE email_id = ? AND lease_owner = ? AND status = 'leased'",
+                [(now + self.lease_seconds, email_id, owner) for email_id in email_ids],
+            )
+
+    def complete(self, owner, email_id, result):
+        """Store the result of a leased item, return False when the lease was lost"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE items SET status = 'done', result = ?, error = NULL, lease_owner = NULL, "
+                "updated = ? WHERE email_id = ? AND lease_owner = ? AND status = 'leased'",
+                (json.dumps(result), time.time(), email_id, owner),
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, owner, email_id, error):
+        """Give a failed item back to the queue, or mark it failed after MAX_ATTEMPTS"""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE items SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "error = ?, lease_owner = NULL, updated = ? "
+                "WHERE email_id = ? AND lease_owner = ? AND status = 'leased'",
+                (MAX_ATTEMPTS, error, time.time(), email_id, owner),
+            )
+
+    def counts(self):
+        """Number of items in each status"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def results(self):
+        """The extracted items of every finished email, by category"""
+        data = {category: [] for category in CATEGORIES.values()}
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT directory, result FROM items WHERE status = 'done' ORDER BY email_id"
+            ).fetchall()
+        for row in rows:
+            data[CATEGORIES[row["directory"]]].extend(json.loads(row["result"]))
+        return data
+
+
+def process_email(email, subject, directory):
+    """Download, extract and upload one email, return its map items"""
+    path = os.path.join(directory, email["id"])
+    remember_subject(email["id"], subject)
+    if not os.path.exists(path):
+        download_email(email, subject, directory)
+        if not os.path.exists(path):
+            # nothing downloaded, like the local pipeline it has no map items
+            print(f"{path}: no attachments downloaded")
+            return []
+
+    if directory == EVENTS_DIR:
+        items = process_events_documents(path)
+    else:
+        items = process_documents(path, subject)
+
+    # this node's uploads, including the one just queued
+    drain_uploads()
+    return resolve_links(items, directory)
+
+
+def lock_working_directory():
+    """
+    Lock the working directory for this process, exit if another worker has it.
+    The lock is held until the returned file is closed.
+    """
+    lock = open(WORKER_LOCK_FILE, "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        raise SystemExit(
+            f"Another worker is running in {os.getcwd()}, "
+            "use --workers for more threads or another working directory"
+        )
+    return lock
+
+
+def work(queue, workers=None, once=False):
+    """Lease and process emails until the queue is empty (or forever unless once)"""
+    workers = workers or RESOURCE_LIMITS["cpu"]
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    leased = {}
+    leased_lock = threading.Lock()
+    stop = threading.Event()
+
+    def heartbeat():
+        # renew well before the lease runs out
+        while not stop.wait(queue.lease_seconds / 3):
+            with leased_lock:
+                email_ids = list(leased)
+            if email_ids:
+                queue.renew(owner, email_ids)
+
+    def run():
+        while True:
+            items = queue.lease(owner)
+            if not items:
+                if once:
+                    return
+                time.sleep(POLL_INTERVAL)
+                continue
+            email, subject, directory = items[0]
+            with leased_lock:
+                leased[email["id"]] = True
+            try:
+                result = process_email(email, subject, directory)
+                if not queue.complete(owner, email["id"], result):
+                    print(f"Lease on {email['id']} lost, result dropped")
+            except Exception as e:
+                traceback.print_exc()
+                queue.fail(owner, email["id"], f"{type(e).__name__}: {e}")
+            finally:
+                with leased_lock:
+                    leased.pop(email["id"], None)
+
+    # the working directory is this process's until every worker is done
+    with lock_working_directory():
+        threading.Thread(target=heartbeat, daemon=True).start()
+        threads = [threading.Thread(target=run, name=f"worker-{i}") for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stop.set()
+
+
+def expired(item):
+    """True when an extracted item is past its closing or end date"""
+    try:
+        if item.get("end_date"):
+            closing = date.fromisoformat(item["end_date"])
+        else:
+            closing = parse_date(item.get("closing_date", ""))
+    except ValueError:
+        return False
+    return is_expired(closing)
+
+
+def coordinate(queue, wait=True, incremental=False):
+    """Queue the matching emails, wait for the workers and export the map data"""
+    added = queue.enqueue(find_emails())
+    print(f"Queued {added} new emails")
+    if not wait:
+        return
+
+    while True:
+        counts = queue.counts()
+        remaining = counts.get("pending", 0) + counts.get("leased", 0)
+        print(f"{remaining} emails left, {counts.get('done', 0)} done, {counts.get('failed', 0)} failed")
+        if not remaining:
+            break
+        time.sleep(POLL_INTERVAL * 6)
+
+    for category, data in queue.results().items():
+        data = save_category(category, [item for item in data if not expired(item)])
+        export_to_map_csv(category, data, incremental=incremental)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distributed backfill over a shared sqlite queue")
+    parser.add_argument("role", choices=["coordinate", "work", "status"])
+    parser.add_argument("--db", default=QUEUE_DB, help="queue database on shared storage")
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="emails processed at once on this node",
+    )
+    parser.add_argument(
+        "--once", action="store_true",
+        help="work: exit when the queue is empty instead of polling",
+    )
+    parser.add_argument(
+        "--no-wait", dest="wait", action="store_false",
+        help="coordinate: only queue the emails, don't wait for the workers and export",
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="coordinate: only export the rows that changed since the last export",
+    )
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.db)
+    if args.role == "coordinate":
+        coordinate(queue, wait=args.wait, incremental=args.incremental)
+    elif args.role == "work":
+        work(queue, workers=args.workers, once=args.once)
+    else:
+        print(queue.counts())